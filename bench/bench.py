@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from datetime import datetime
+from functools import partial
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from bench.mock_server import MockKemono  # noqa: E402
+from modules.ratelimit import parse_size  # noqa: E402
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# ダウンロードの引数 (main.pyのデフォルト値と同じ)
+def download_args(jobs: int) -> Namespace:
+    args = Namespace(
+        url=None,
+        from_file=None,
+        page=None,
+        word=None,
+        block_word=None,
+        tag=None,
+        cover=False,
+        flat=False,
+        full=True,
+        jobs=jobs,
+        rate=1000,
+        limit_rate=None,
+        segment_size=64 * 1024 * 1024,
+        segments=4,
+        stats=None,
+        no_cache=True,
+        no_mirror=True,
+        cache_ttl=600,
+        extract=False,
+        extract_jobs=2,
+        extract_memory=None,
+        preview=False,
+        preview_jobs=2,
+        preview_memory=None,
+        phash=False,
+        skip_similar=False,
+        distance=6,
+    )
+    for k in ["image", "archive", "movie", "sound", "psd", "pdf"]:
+        setattr(args, k, False)
+    return args
+
+
+# 起動時間を計測するコマンド (ダウンロード以外は重いモジュールを読み込まない)
+startup_commands = {"version": ["-v"], "help": ["-h"], "search": ["search", "bench creator"]}
+
+
+# 各コマンドの起動から終了までの時間
+def bench_startup(base_url: str, workdir: str, runs: int) -> dict:
+    env = dict(os.environ, SERVAL_BASE_URL=base_url)
+    results = {}
+    for name, command in startup_commands.items():
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, os.path.join(root, "main.py"), *command],
+                cwd=workdir,
+                env=env,
+                check=True,
+                capture_output=True,
+            )
+            times.append(time.perf_counter() - start)
+        results[name] = {"runs": runs, "median_ms": statistics.median(times) * 1000, "max_ms": max(times) * 1000}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="モックサーバーを使ったベンチマーク")
+    parser.add_argument("--creators", type=int, default=100000, help="ユーザー一覧の件数")
+    parser.add_argument("--posts", type=int, default=200, help="投稿数")
+    parser.add_argument("--attachments", type=int, default=5, help="投稿毎の添付ファイル数")
+    parser.add_argument("--messages", type=int, default=0, help="discordのチャンネルのメッセージ数 (0の場合は計測しない)")
+    parser.add_argument("--file-size", type=parse_size, default=64 * 1024, help="添付ファイルのサイズ")
+    parser.add_argument("--latency", type=float, default=0.0, help="リクエスト毎の遅延 (秒)")
+    parser.add_argument("--bandwidth", type=parse_size, help="接続毎の帯域")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503を返す割合")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="同時にダウンロードするファイル数")
+    parser.add_argument("--searches", type=int, default=100, help="検索の試行回数")
+    parser.add_argument("--startup-runs", type=int, default=5, help="起動時間の試行回数")
+    parser.add_argument(
+        "--max-startup-ms", type=float, help="起動時間の中央値がこれを超えるコマンドがある場合は終了コード1で終了"
+    )
+    parser.add_argument("-o", "--output", type=str, default="bench.json", help="結果を書き込むJSONファイル")
+    args = parser.parse_args()
+
+    mock = MockKemono(
+        creators=args.creators,
+        posts=args.posts,
+        attachments=args.attachments,
+        messages=args.messages,
+        file_size=args.file_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+    )
+    base_url = mock.start()
+    os.environ["SERVAL_BASE_URL"] = base_url
+    output = os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        from modules import global_var
+        from modules.client import Client
+
+        global_var.args = download_args(args.jobs)
+        global_var.args_dict = vars(global_var.args)
+        results = {}
+
+        # ユーザー一覧の取得
+        start = time.perf_counter()
+        client = Client()
+        results["creators_update"] = {"creators": args.creators, "seconds": time.perf_counter() - start}
+
+        # ユーザー検索
+        words = [c["name"][-4:] for c in mock.random.sample(mock.creators, min(args.searches, len(mock.creators)))]
+        times = []
+        hits = 0
+        for word in words:
+            start = time.perf_counter()
+            hits = hits + len(client.search_creator(word, None, 100))
+            times.append(time.perf_counter() - start)
+        results["search"] = {
+            "queries": len(times),
+            "hits": hits,
+            "median_ms": statistics.median(times) * 1000,
+            "p95_ms": percentile(times, 0.95) * 1000,
+        }
+
+        # 列挙からダウンロードまで
+        client.api.limiter.configure(global_var.args.rate, global_var.args.limit_rate)
+        client.api.cache.configure(not global_var.args.no_cache, global_var.args.cache_ttl)
+        client.api.mirrors.configure(not global_var.args.no_mirror)
+        client.api.configure_segments(global_var.args.segment_size, global_var.args.segments)
+        start = time.perf_counter()
+        result = client.download(partial(client.creator, "fanbox", "1"))
+        seconds = time.perf_counter() - start
+        results["download"] = {
+            "posts": result["posts"],
+            "files": result["files"],
+            "failed": result["failed"],
+            "bytes": result["size"],
+            "seconds": seconds,
+            "files_per_second": result["files"] / seconds,
+            "bytes_per_second": result["size"] / seconds,
+        }
+
+        # discordのチャンネル
+        if args.messages:
+            start = time.perf_counter()
+            result = client.download(partial(client.discord_channel, "1", "100", "general"))
+            seconds = time.perf_counter() - start
+            results["discord"] = {
+                "messages": args.messages,
+                "files": result["files"],
+                "seconds": seconds,
+                "messages_per_second": args.messages / seconds,
+            }
+
+        results["startup"] = bench_startup(base_url, workdir, args.startup_runs)
+        os.chdir(root)
+
+    mock.stop()
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True
+        ).stdout.strip(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "server": {"requests": mock.requests, "errors": mock.errors},
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(json.dumps(results, indent=4))
+
+    # 起動時間の劣化を検出する
+    if args.max_startup_ms is not None:
+        slow = {k: v["median_ms"] for k, v in results["startup"].items() if v["median_ms"] > args.max_startup_ms}
+        if slow:
+            for name, median in slow.items():
+                print(f"startup of {name} took {median:.1f} ms (> {args.max_startup_ms} ms)", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
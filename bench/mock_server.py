@@ -0,0 +1,181 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+
+# kemonoのAPIを模したローカルサーバー
+class MockKemono:
+    def __init__(
+        self,
+        creators: int = 1000,
+        posts: int = 200,
+        attachments: int = 5,
+        messages: int = 0,
+        file_size: int = 64 * 1024,
+        latency: float = 0.0,
+        bandwidth: int | None = None,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.posts = posts
+        self.attachments = attachments
+        self.file_size = file_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+        self.creators = [
+            {
+                "id": str(i),
+                "name": f"creator{i}_{self.random.randrange(16**6):06x}",
+                "service": self.random.choice(["fanbox", "patreon", "fantia"]),
+                "indexed": 1700000000 + i,
+                "updated": 1700000000 + i,
+                "favorited": self.random.randrange(10000),
+            }
+            for i in range(max(2, creators))
+        ]
+        # 投稿の作成者
+        self.creators[1].update({"name": "bench creator", "service": "fanbox"})
+        # 作成したファイルの内容はハッシュから再生成する
+        self.files = {}
+        self._posts = [self._post(i) for i in range(posts)]
+        # discordのチャンネル (サーバー1のチャンネル100) のメッセージ
+        self.messages = [self._message(i) for i in range(messages)]
+        self.server = None
+
+    def content(self, index: int) -> bytes:
+        seed = f"file-{index}-".encode()
+        return (seed * (self.file_size // len(seed) + 1))[: self.file_size]
+
+    def _post(self, i: int) -> dict:
+        attachments = []
+        for j in range(self.attachments):
+            index = i * self.attachments + j
+            digest = hashlib.sha256(self.content(index)).hexdigest()
+            self.files[digest] = index
+            attachments.append({"name": f"{j}.png", "path": f"/{digest[:2]}/{digest[2:4]}/{digest}.png"})
+        return {
+            "id": str(1000000 + self.posts - i),
+            "user": "1",
+            "service": "fanbox",
+            "title": f"post {i}",
+            "published": (datetime(2024, 1, 1) + timedelta(minutes=self.posts - i)).isoformat(),
+            "file": {},
+            "attachments": attachments,
+        }
+
+    def _message(self, i: int) -> dict:
+        index = self.posts * self.attachments + i
+        digest = hashlib.sha256(self.content(index)).hexdigest()
+        self.files[digest] = index
+        return {
+            "id": str(3000000 - i),
+            "server": "1",
+            "channel": "100",
+            "content": f"message {i}",
+            "published": (datetime(2024, 1, 1) + timedelta(minutes=100000 - i)).isoformat(),
+            "attachments": [{"name": "image.png", "path": f"/{digest[:2]}/{digest[2:4]}/{digest}.png"}],
+        }
+
+    def start(self) -> str:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                mock.handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle(self, handler: BaseHTTPRequestHandler):
+        with self.lock:
+            self.requests = self.requests + 1
+            error = self.random.random() < self.error_rate
+            if error:
+                self.errors = self.errors + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if error:
+            self.send(handler, 503, b"", "text/plain")
+            return
+
+        url = parse.urlparse(handler.path)
+        query = parse.parse_qs(url.query)
+        if url.path == "/api/v1/app_version":
+            self.send(handler, 200, b"mock", "text/plain")
+        elif url.path == "/api/v1/creators.txt":
+            self.send(handler, 200, json.dumps(self.creators).encode(), "application/json")
+        elif re.fullmatch(r"/api/v1/(\w+)/user/(\w+)/posts", url.path):
+            offset = int(query.get("o", ["0"])[0])
+            self.send(handler, 200, json.dumps(self._posts[offset : offset + 50]).encode(), "application/json")
+        elif m := re.fullmatch(r"/api/v1/(\w+)/user/(\w+)/post/(\w+)", url.path):
+            for post in self._posts:
+                if post["id"] == m.group(3):
+                    self.send(handler, 200, json.dumps({"post": post}).encode(), "application/json")
+                    return
+            self.send(handler, 404, json.dumps({"error": "Not Found"}).encode(), "application/json")
+        elif re.fullmatch(r"/api/v1/discord/channel/lookup/(\w+)", url.path):
+            self.send(handler, 200, json.dumps([{"id": "100", "name": "general"}]).encode(), "application/json")
+        elif re.fullmatch(r"/api/v1/discord/channel/(\w+)", url.path):
+            offset = int(query.get("o", ["0"])[0])
+            page = self.messages[offset : offset + 150]
+            self.send(handler, 200, json.dumps(page).encode(), "application/json")
+        elif m := re.fullmatch(r"/data/+\w{2}/\w{2}/(\w{64})\.\w+", url.path):
+            if m.group(1) not in self.files:
+                self.send(handler, 404, b"", "text/plain")
+                return
+            body = self.content(self.files[m.group(1)])
+            r = re.fullmatch(r"bytes=(\d+)-(\d*)", handler.headers.get("Range", ""))
+            if r is None:
+                self.send(handler, 200, body, "application/octet-stream")
+                return
+            start = int(r.group(1))
+            end = min(int(r.group(2)) if r.group(2) else len(body) - 1, len(body) - 1)
+            if start >= len(body):
+                self.send(handler, 416, b"", "text/plain", {"Content-Range": f"bytes */{len(body)}"})
+                return
+            headers = {"Content-Range": f"bytes {start}-{end}/{len(body)}"}
+            self.send(handler, 206, body[start : end + 1], "application/octet-stream", headers)
+        else:
+            self.send(handler, 404, b"", "text/plain")
+
+    # 帯域 (接続毎) が指定されている場合は少しずつ送信する
+    def send(
+        self, handler: BaseHTTPRequestHandler, status: int, body: bytes, content_type: str, headers: dict | None = None
+    ):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        if self.bandwidth is None:
+            handler.wfile.write(body)
+            return
+        chunk = max(1024, self.bandwidth // 20)
+        for i in range(0, len(body), chunk):
+            handler.wfile.write(body[i : i + chunk])
+            time.sleep(len(body[i : i + chunk]) / self.bandwidth)
@@ -4,40 +4,82 @@ import os
 import re
 import signal
 import sys
+from datetime import datetime
+from functools import partial
 from urllib import parse
 
-import requests
-from bs4 import BeautifulSoup as bs
-
 from modules import global_var
-from modules.api import APIError
-from modules.client import Client
-from modules.common import Color, Table
-from modules.global_var import domain, sld, tld, base_url, user_agent
+from modules.common import Color, Table, convert_size, logger
+from modules.metrics import metrics
+from modules.ratelimit import parse_size
+from modules.global_var import domain, sld, tld, base_url
+
+
+# 各サイトのページからユーザIDを含む部分を取り出す正規表現
+og_image = re.compile(r"<meta[^>]*property=[\"']og:image[\"'][^>]*>")
+ld_json = re.compile(r"<script[^>]*type=[\"']application/ld\+json[\"'][^>]*>(.*?)</script>", re.S)
+next_data = re.compile(r"<script[^>]*id=[\"']__NEXT_DATA__[\"'][^>]*>(.*?)</script>", re.S)
+gumroad_profile = re.compile(r"<script[^>]*data-component-name=[\"']Profile[\"'][^>]*>(.*?)</script>", re.S)
+
+
+# Clientはユーザー一覧の読み込みと重いモジュールのimportを伴うので、必要なサブコマンドでのみ作成する
+def get_client():
+    global client
+    if client is None:
+        from modules.client import Client
+
+        client = Client()
+    return client
+
+
+# 解決済みのIDがあればそれを返し、無ければページの必要な部分だけ受信して取得する
+def resolve_id(key, url, pattern, extract):
+    api = get_client().api
+    if (user_id := api.cache.resolved(key)) is not None:
+        return user_id
+    if (m := api.scan(url, pattern)) is None:
+        return None
+    try:
+        user_id = str(extract(m))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    api.cache.set_resolved(key, user_id)
+    return user_id
+
+
+def fanbox_id(m):
+    content = re.search(r"content=[\"']([^\"']*)", m.group(0)).group(1)
+    return re.match(r"https://pixiv.pximg.net/c/\w+/fanbox/public/images/creator/(\d+)", content).group(1)
+
+
+def fantia_id(m):
+    user_url = json.loads(m.group(1))["author"]["url"]
+    return re.fullmatch(r"https://fantia\.jp/(fanclubs|posts)/(\d+)/?", user_url).group(2)
+
+
+def patreon_post_id(m):
+    bootstrap = json.loads(m.group(1))["props"]["pageProps"]["bootstrapEnvelope"]["bootstrap"]
+    return bootstrap["post"]["data"]["relationships"]["user"]["data"]["id"]
+
+
+def patreon_creator_id(m):
+    bootstrap = json.loads(m.group(1))["props"]["pageProps"]["bootstrapEnvelope"]["bootstrap"]
+    return bootstrap["campaign"]["data"]["relationships"]["creator"]["data"]["id"]
+
+
+def gumroad_id(m):
+    return json.loads(m.group(1))["creator_profile"]["external_id"]
 
 
 # ページを解析してユーザIDを取得、urlを生成する
 def url_gen(url):
-    headers = {
-        "User-Agent": user_agent
-    }
     parse_result = parse.urlparse(url)
     url_domain = parse_result.hostname
     if m := re.match(rf"{sld}\.({'|'.join(tld)})", url_domain):
         kemono_path = parse_result.path
     elif re.fullmatch(r"\w+\.fanbox\.cc", url_domain):
-        res = requests.get(f"https://{url_domain}", headers=headers)
-        if res.status_code == 404:
-            return None
-        soup = bs(res.text, "html.parser")
-        og_image = soup.select_one("head > meta[property='og:image']")
-        content = og_image.get("content")
-        try:
-            user_id = re.match(
-                r"https://pixiv.pximg.net/c/\w+/fanbox/public/images/creator/(\d+)",
-                content,
-            ).group(1)
-        except AttributeError:
+        user_id = resolve_id(f"fanbox:{url_domain}", f"https://{url_domain}", og_image, fanbox_id)
+        if user_id is None:
             return None
         if m := re.match(r"https://(\w+)\.fanbox\.cc/posts/(\d+)", url):
             kemono_path = f"/fanbox/user/{user_id}/post/{m.group(2)}"
@@ -57,45 +99,35 @@ def url_gen(url):
             if m.group(1) == "fanclubs":
                 kemono_path = f"/fantia/user/{m.group(2)}"
             else:
-                res = requests.get(url, headers=headers)
-                if res.status_code == 404:
+                user_id = resolve_id(f"fantia:post:{m.group(2)}", url, ld_json, fantia_id)
+                if user_id is None:
                     return None
-                soup = bs(res.text, "html.parser")
-                user = json.loads(soup.select_one("head script[type='application/ld+json']").text)
-                user_url = user["author"]["url"]
-                m_ = re.fullmatch(r"https://fantia\.jp/(fanclubs|posts)/(\d+)/?", user_url)
-                kemono_path = f"/fantia/user/{m_.group(2)}/post/{m.group(2)}"
+                kemono_path = f"/fantia/user/{user_id}/post/{m.group(2)}"
         else:
             return None
     elif "www.patreon.com" == url_domain:
         if m := re.fullmatch(r"https://www.patreon.com/user(/posts)?\?u=(\d+)", url):
             kemono_path = f"/patreon/user/{m.group(2)}"
         elif m := re.match(r"https://www\.patreon\.com/(\w+)/?", url):
-            res = requests.get(url, headers=headers)
-            if res.status_code == 404:
-                return None
-            soup = bs(res.text, "html.parser")
-            user = json.loads(soup.select_one("#__NEXT_DATA__").text)
             if m.group(1) == "posts":
                 m = re.fullmatch(r"https://www\.patreon\.com/posts/(.+)-(\w+)/?", url)
-                user_id = user["props"]["pageProps"]["bootstrapEnvelope"]["bootstrap"]["post"]["data"]["relationships"][
-                    "user"
-                ]["data"]["id"]
+                if m is None:
+                    return None
+                user_id = resolve_id(f"patreon:post:{m.group(2)}", url, next_data, patreon_post_id)
+                if user_id is None:
+                    return None
                 kemono_path = f"/patreon/user/{user_id}/post/{m.group(2)}"
             else:
-                user_id = user["props"]["pageProps"]["bootstrapEnvelope"]["bootstrap"]["campaign"]["data"][
-                    "relationships"
-                ]["creator"]["data"]["id"]
+                user_id = resolve_id(f"patreon:{m.group(1).lower()}", url, next_data, patreon_creator_id)
+                if user_id is None:
+                    return None
                 kemono_path = f"/patreon/user/{user_id}"
         else:
             return None
     elif re.fullmatch(r"\w+\.gumroad.com", url_domain):
-        res = requests.get(f"https://{url_domain}", headers=headers)
-        if res.status_code == 404:
+        user_id = resolve_id(f"gumroad:{url_domain}", f"https://{url_domain}", gumroad_profile, gumroad_id)
+        if user_id is None:
             return None
-        soup = bs(res.text, "html.parser")
-        user = json.loads(soup.select_one("body script[data-component-name='Profile']").text)
-        user_id = user["creator_profile"]["external_id"]
         if m := re.match(r"https://(\w+)\.gumroad\.com/l/(\w+)", url):
             kemono_path = f"/gumroad/user/{user_id}/post/{m.group(2)}"
         else:
@@ -109,7 +141,17 @@ def url_gen(url):
 # ユーザー一覧を更新
 def update():
     print("Updating Creators...")
-    client.creators(True)
+    summary = get_client().creators(True)
+    if summary is None:
+        print(Color.GREEN + "Creators is already up to date." + Color.RESET)
+        return
+
+    table = Table()
+    table.add_column("Added")
+    table.add_column("Removed")
+    table.add_column("Renamed")
+    table.add_row(str(summary["added"]), str(summary["removed"]), str(summary["renamed"]))
+    table.print()
     print(Color.GREEN + "Creators was updated successfully!" + Color.RESET)
 
 
@@ -118,7 +160,7 @@ def search():
     if global_var.args.update:
         update()
 
-    creators_data = client.search_creator(global_var.args.name, global_var.args.service)
+    creators_data = get_client().search_creator(global_var.args.name, global_var.args.service, global_var.args.limit)
     if not creators_data:
         print(f'{Color.YELLOW}Not found "{global_var.args.name}" in creators list.{Color.RESET}')
         print(
@@ -139,7 +181,81 @@ def search():
     table.print()
 
 
+# 似た画像の組を表示
+def similar():
+    client = get_client()
+    if global_var.args.scan:
+        print(f"Indexed {client.index_images()} images.")
+
+    table = Table()
+    table.add_column("Distance")
+    table.add_column("File")
+    table.add_column("Similar to")
+    count = 0
+    for path, other, distance in client.phash.pairs(global_var.args.distance):
+        # 重複排除でリンクされた同じファイルは除く
+        if not os.path.exists(path) or not os.path.exists(other) or os.path.samefile(path, other):
+            continue
+        table.add_row(str(distance), os.path.relpath(path), os.path.relpath(other))
+        count = count + 1
+        if count >= global_var.args.limit:
+            break
+    if not count:
+        Color.info("No similar images found.")
+        return
+
+    table.print()
+
+
+# 重複排除で節約した容量を表示
+def store():
+    report = get_client().store.report()
+
+    table = Table()
+    table.add_column("Objects")
+    table.add_column("Links")
+    table.add_column("Bandwidth saved")
+    table.add_column("Disk saved")
+    table.add_row(
+        str(report["objects"]), str(report["links"]), convert_size(report["bandwidth"]), convert_size(report["disk"])
+    )
+    table.print()
+
+
+# ダウンロード記録を表示
+def ledger():
+    client = get_client()
+    rows = client.ledger.summary(global_var.args.service, global_var.args.creator, global_var.args.status)
+    if not rows:
+        Color.warn("There is nothing in the ledger.")
+        return
+
+    table = Table()
+    table.add_column("Service")
+    table.add_column("ID")
+    table.add_column("Name")
+    table.add_column("Status")
+    table.add_column("Files")
+    table.add_column("Size")
+    table.add_column("Last")
+
+    for service, creator_id, status, files, size, last in rows:
+        table.add_row(
+            service,
+            creator_id,
+            client.creator_info(creator_id, service).get("name", ""),
+            status,
+            str(files),
+            convert_size(size),
+            datetime.fromtimestamp(last).strftime("%Y-%m-%d %H:%M:%S"),
+        )
+
+    table.print()
+
+
 def main():
+    from modules.api import APIError
+
     args_error = False
     if global_var.args.word is not None and len(global_var.args.word) < 2:
         Color.warn('For "word": Value must be at least 2 characters.')
@@ -149,36 +265,115 @@ def main():
         args_error = True
     if args_error:
         return
-    url = url_gen(global_var.args.url)
-    parse_result = parse.urlparse(url)
-    if parse_result.hostname == domain:
-        global_var.args_dict = vars(global_var.args)
-        global_var.enable_filter = any([global_var.args_dict[k] for k in global_var.types])
+    global_var.args_dict = vars(global_var.args)
+    global_var.enable_filter = any([global_var.args_dict[k] for k in global_var.types])
+    client = get_client()
+    client.api.limiter.configure(global_var.args.rate, global_var.args.limit_rate)
+    client.api.cache.configure(not global_var.args.no_cache, global_var.args.cache_ttl)
+    client.api.mirrors.configure(not global_var.args.no_mirror)
+    client.api.configure_segments(global_var.args.segment_size, global_var.args.segments)
+    if pending := client.journal.pending()[1]:
+        Color.warn(
+            f"{len(pending)} posts from an interrupted or failed download are left. Run `resume` to finish them."
+        )
+
+    # 引数のurlとファイルのurlをまとめてダウンロードする
+    urls = []
+    if global_var.args.url is not None:
+        urls.append(global_var.args.url)
+    if global_var.args.from_file is not None:
+        if global_var.args.from_file == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(global_var.args.from_file, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        urls.extend(line.strip() for line in lines if line.strip() and not line.startswith("#"))
+    if not urls:
+        Color.warn("No url specified.")
+        return
 
+    producers = []
+    for url in urls:
         try:
-            if result := re.match(r"/discord/server/(\d+)/(\d+)", parse_result.path):
-                server_id, channel_id = result.groups()  # noqa: F841
-                return
-            elif result := re.match(r"/discord/server/(\d+)", parse_result.path):
-                server_id = result.groups()  # noqa: F841
-                return
-            if result := re.match(rf"/({'|'.join(services)})/user/(\w+)/post/(\w+)", parse_result.path):
-                service, creator_id, post_id = result.groups()
-                client.post(service, creator_id, post_id)
-            elif result := re.match(rf"/({'|'.join(services)})/user/(\w+)", parse_result.path):
-                service, creator_id = result.groups()
-                client.creator(service, creator_id)
+            producer = resolve(url)
         except APIError as e:
             Color.error(str(e))
-            return
+            continue
+        # ページの取得やJSONの解析に失敗した場合もこのurlだけ飛ばす
+        except Exception as e:
+            logger.debug(f"{url}: {type(e).__name__}: {e}", exc_info=True)
+            Color.error(f"{url}: {type(e).__name__}: {e}")
+            continue
+        if producer is None:
+            Color.warn(f"Unsupported url: {url}")
+            continue
+        producers.append(producer)
+    if not producers:
+        return
 
-        try:
-            client.download()
-        except KeyboardInterrupt:
-            Color.warn("Download interrupted.")
+    try:
+        client.download(*producers)
+    except KeyboardInterrupt:
+        Color.warn("Download interrupted.")
+    finally:
+        if global_var.args.stats is not None:
+            metrics.write(global_var.args.stats)
+
+
+# 中断したダウンロードをジャーナルから再開 (引数は中断した時のものを使う)
+def resume():
+    client = get_client()
+    args, pending = client.journal.pending()
+    if not pending:
+        Color.info("There is nothing to resume.")
+        return
+    jobs = global_var.args.jobs
+    global_var.args = argparse.Namespace(**args)
+    if jobs is not None:
+        global_var.args.jobs = jobs
+    global_var.args_dict = vars(global_var.args)
+    global_var.enable_filter = any([global_var.args_dict[k] for k in global_var.types])
+    client.api.limiter.configure(global_var.args.rate, global_var.args.limit_rate)
+    client.api.cache.configure(not global_var.args.no_cache, global_var.args.cache_ttl)
+    client.api.mirrors.configure(not getattr(global_var.args, "no_mirror", False))
+    client.api.configure_segments(
+        getattr(global_var.args, "segment_size", None), getattr(global_var.args, "segments", 1)
+    )
+
+    print(f"Resuming {len(pending)} posts.")
+    try:
+        client.download(partial(client.resume, pending))
+    except KeyboardInterrupt:
+        Color.warn("Download interrupted.")
+    finally:
+        if global_var.args.stats is not None:
+            metrics.write(global_var.args.stats)
+
+
+# urlから投稿を列挙する関数を作成
+def resolve(url):
+    url = url_gen(url)
+    if url is None:
+        return None
+    parse_result = parse.urlparse(url)
+    if parse_result.hostname != domain:
+        return None
+    if result := re.match(r"/discord/server/(\d+)/(\d+)", parse_result.path):
+        server_id, channel_id = result.groups()
+        return partial(get_client().discord_channel, server_id, channel_id)
+    elif result := re.match(r"/discord/server/(\d+)", parse_result.path):
+        server_id = result.group(1)
+        return partial(get_client().discord_server, server_id)
+    if result := re.match(rf"/({'|'.join(services)})/user/(\w+)/post/(\w+)", parse_result.path):
+        service, creator_id, post_id = result.groups()
+        return partial(get_client().post, service, creator_id, post_id)
+    elif result := re.match(rf"/({'|'.join(services)})/user/(\w+)", parse_result.path):
+        service, creator_id = result.groups()
+        return partial(get_client().creator, service, creator_id)
+    return None
 
 
-client = Client()
+client = None
 services = ["patreon", "fanbox", "discord", "fantia", "afdian", "boosty", "gumroad", "subscribestar", "dlsite"]
 version = "0.3"
 signal.signal(signal.SIGINT, signal.SIG_DFL)
@@ -203,7 +398,10 @@ if __name__ == "__main__":
         help="urlを基にダウンロードします",
         epilog=f"対応サイト一覧: [{sld}({', '.join(tld)}), pixiv.net, fanbox.cc(不安定), fantia.jp, patreon.com, gumroad.com]",
     )
-    _download.add_argument("url", type=str, help="urlを指定します (対応サイト一覧参照)")
+    _download.add_argument("url", type=str, nargs="?", help="urlを指定します (対応サイト一覧参照)")
+    _download.add_argument(
+        "-f", "--from-file", type=str, help="ファイルに書かれたurlをまとめてダウンロードします (-で標準入力)"
+    )
     _download.add_argument("-p", "--page", type=int, help="指定したページの投稿のみをダウンロードします")
     _download.add_argument(
         "-w", "--word", type=str, help="指定したワードがタイトルに入っている場合ダウンロードします (二文字以上限定)"
@@ -222,18 +420,77 @@ if __name__ == "__main__":
     # _download.add_argument("--url", action="store_true", help="投稿本文にあるurlのショートカットを作成します")
     _download.add_argument("--cover", action="store_true", help="カバー/ヘッダー画像があるかどうか解析します (fanboxのみ)")
     _download.add_argument("--flat", action="store_true", help="投稿毎にフォルダを作成しないようにします")
-    # _download.add_argument("-e", "--extract", action="store_true", help="圧縮ファイルを解凍します (解凍する場合は新しいフォルダの中に展開します)")
+    _download.add_argument("--full", action="store_true", help="前回の同期位置を無視して全ての投稿を取得します")
+    _download.add_argument("-j", "--jobs", type=int, default=4, help="同時にダウンロードするファイル数 (デフォルト: 4)")
+    _download.add_argument(
+        "--rate", type=float, default=10, help="ホスト毎の1秒あたりのリクエスト数の上限 (デフォルト: 10)"
+    )
+    _download.add_argument("--limit-rate", type=parse_size, help="ホスト毎の帯域の上限 (例: 500K, 5M)")
+    _download.add_argument(
+        "--segment-size",
+        type=parse_size,
+        default=64 * 1024 * 1024,
+        help="この大きさを超えるファイルは分割して並行にダウンロードします (デフォルト: 64M、0で分割しない)",
+    )
+    _download.add_argument("--segments", type=int, default=4, help="1ファイルあたりの同時接続数 (デフォルト: 4)")
+    _download.add_argument("--no-cache", action="store_true", help="APIのキャッシュを使用しません")
+    _download.add_argument(
+        "--cache-ttl", type=float, default=600, help="APIのキャッシュの有効期限 (秒、デフォルト: 600)"
+    )
+    _download.add_argument(
+        "--no-mirror", action="store_true", help="ミラーを自動で選択せずに常に既定のホストを使用します"
+    )
+    _download.add_argument("--stats", type=str, help="計測値をファイルに書き込みます (拡張子が.promの場合はPrometheus形式)")
+    _download.add_argument(
+        "-e", "--extract", action="store_true", help="圧縮ファイルを解凍します (解凍する場合は新しいフォルダの中に展開します)"
+    )
+    _download.add_argument("--extract-jobs", type=int, default=2, help="同時に解凍するファイル数 (デフォルト: 2)")
+    _download.add_argument(
+        "--extract-memory", type=parse_size, help="解凍するプロセス毎のメモリの上限 (例: 512M、Linux/macOSのみ)"
+    )
+    _download.add_argument(
+        "--preview", action="store_true", help="psdと画像のサムネイル (psdと大きな画像はプレビューも) を.previewフォルダに作成します"
+    )
+    _download.add_argument("--preview-jobs", type=int, default=2, help="同時にプレビューを作成するファイル数 (デフォルト: 2)")
+    _download.add_argument(
+        "--preview-memory", type=parse_size, help="プレビューを作成するプロセス毎のメモリの上限 (例: 2G、Linux/macOSのみ)"
+    )
+    _download.add_argument("--phash", action="store_true", help="画像の知覚ハッシュを記録して、似た画像を表示します")
+    _download.add_argument(
+        "--skip-similar", action="store_true", help="既にある画像とほぼ同じ画像を削除します (--phashを含む)"
+    )
+    _download.add_argument("--distance", type=int, default=6, help="似ていると判定するハミング距離 (デフォルト: 6)")
     _download.set_defaults(handler=main)
 
+    _resume = subparser.add_parser("resume", help="中断したダウンロードを再開します")
+    _resume.add_argument("-j", "--jobs", type=int, help="同時にダウンロードするファイル数 (デフォルト: 中断した時の値)")
+    _resume.set_defaults(handler=resume)
+
     _search = subparser.add_parser("search", help="ユーザーを検索します")
     _search.add_argument("name", type=str, help="検索するユーザー名")
     _search.add_argument("--service", choices=services, help="検索するサイトを指定")
+    _search.add_argument("--limit", type=int, default=100, help="表示する件数 (デフォルト: 100)")
     _search.add_argument("--update", action="store_true", help="ユーザー一覧を更新したあとに検索します")
     _search.set_defaults(handler=search)
 
     _update = subparser.add_parser("update", help="ユーザー一覧を更新します")
     _update.set_defaults(handler=update)
 
+    _ledger = subparser.add_parser("ledger", help="ダウンロード記録を表示します")
+    _ledger.add_argument("--service", choices=services, help="サイトを指定")
+    _ledger.add_argument("--creator", type=str, help="ユーザーIDを指定")
+    _ledger.add_argument("--status", choices=["complete", "failed", "similar"], help="状態を指定")
+    _ledger.set_defaults(handler=ledger)
+
+    _store = subparser.add_parser("store", help="重複排除で節約した容量を表示します")
+    _store.set_defaults(handler=store)
+
+    _similar = subparser.add_parser("similar", help="知覚ハッシュが近い画像の組を表示します")
+    _similar.add_argument("--distance", type=int, default=6, help="似ていると判定するハミング距離 (デフォルト: 6)")
+    _similar.add_argument("--limit", type=int, default=100, help="表示する件数 (デフォルト: 100)")
+    _similar.add_argument("--scan", action="store_true", help="img内の未登録の画像を登録してから表示します")
+    _similar.set_defaults(handler=similar)
+
     # 引数をグローバル変数に
     global_var.args = parser.parse_args()
     print(global_var.args)
@@ -1,65 +1,246 @@
-import shutil
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
 
 import requests
 import requests.adapters
+from urllib3.exceptions import ProtocolError
 
-from .global_var import base_url, user_agent
+from .cache import Cache
+from .global_var import base_url, mirrors, user_agent
+from .metrics import metrics
+from .mirror import Mirrors
+from .ratelimit import RateLimiter, retry_after
 
 headers = {"Accept": "application/json"}
+separator = re.compile(r"[\s,\[]*")
 error_messages = {"503": "API is in maintenance or not available."}
 
 
 def error_hooks(r: requests.Response, *args, **kwargs):
     if r.status_code == 503:
-        APIError("API is in maintenance or not available.")
+        raise APIError("API is in maintenance or not available.")
 
 
 class APIError(Exception):
     pass
 
 
+class IntegrityError(Exception):
+    pass
+
+
+# JSON配列を受信しながら一要素ずつ返す
+def iter_json(res: requests.Response):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    with res:
+        for chunk in res.iter_content(chunk_size=65536, decode_unicode=True):
+            buffer = buffer + chunk
+            pos = 0
+            while True:
+                pos = separator.match(buffer, pos).end()
+                if pos < len(buffer) and buffer[pos] == "]":
+                    return
+                try:
+                    obj, pos_ = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    break
+                pos = pos_
+                yield obj
+            buffer = buffer[pos:]
+    # 配列の終わりまで受信できなかった
+    raise APIError("Failed to parse response.")
+
+
+# urllib3内部の再試行を原因毎に数える
+class CountingRetry(requests.adapters.Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        metrics.retry(str(response.status) if response is not None else type(error).__name__)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+# ホスト毎の速度制限を掛けて、429/503の場合は速度を落として再試行する
+# kemono宛てのリクエストは速いミラーに振り分けて、接続できない/5xxの場合は別のミラーで再試行する
+class LimitedAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, limiter: RateLimiter, mirrors: Mirrors, attempts: int = 5, **kwargs):
+        self.limiter = limiter
+        self.mirrors = mirrors
+        self.attempts = attempts
+        self.local = threading.local()
+        super().__init__(**kwargs)
+
+    # 別のミラーに切り替えられる間は同じミラーで再試行しない
+    @property
+    def max_retries(self):
+        return getattr(self.local, "retries", None) or self._max_retries
+
+    @max_retries.setter
+    def max_retries(self, value):
+        self._max_retries = value
+
+    def send(self, request, **kwargs):
+        url = request.url
+        kind = "data" if re.match(r"/(data|thumbnail)/", parse.urlparse(url).path) else "api"
+        # リダイレクト先は振り分けない (ミラーが本来のホストにリダイレクトした場合に往復しないように)
+        if not getattr(request, "route", False):
+            self.local.retries = None
+            return self._send(request, kind, **kwargs)
+        tried = set()
+        while True:
+            request.url, endpoint = self.mirrors.route(url, kind, tried)
+            alternative = endpoint is not None and self.mirrors.has_alternative(tried | {endpoint.netloc})
+            self.local.retries = self._max_retries.new(total=0) if alternative else None
+            start = time.monotonic()
+            try:
+                response = self._send(request, kind, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if endpoint is None:
+                    raise
+                self.mirrors.failed(endpoint)
+                tried.add(endpoint.netloc)
+                if not self.mirrors.has_alternative(tried):
+                    raise
+                metrics.retry("failover")
+                continue
+            if endpoint is None:
+                return response
+            if response.status_code >= 500 and alternative:
+                self.mirrors.failed(endpoint)
+                tried.add(endpoint.netloc)
+                response.close()
+                metrics.retry("failover")
+                continue
+            self.mirrors.observe(endpoint, time.monotonic() - start)
+            # 転送速度の記録に使う
+            response.mirror = endpoint
+            return response
+
+    def _send(self, request, kind: str, **kwargs):
+        limiter = self.limiter.host(parse.urlparse(request.url).hostname)
+        for i in range(self.attempts):
+            limiter.acquire()
+            start = time.monotonic()
+            response = super().send(request, **kwargs)
+            metrics.observe(kind, time.monotonic() - start)
+            if response.status_code in (429, 503):
+                metrics.retry(str(response.status_code))
+                limiter.throttled(retry_after(response.headers.get("Retry-After")))
+                if i < self.attempts - 1:
+                    response.close()
+                    continue
+            else:
+                limiter.healthy()
+            return response
+
+
+# セッションから送る最初のリクエストだけをミラーに振り分ける対象にする
+# (リダイレクトはallow_redirects=Falseでコピーしたリクエストを送るので対象外になる)
+class Session(requests.Session):
+    def send(self, request, **kwargs):
+        if kwargs.get("allow_redirects", True):
+            request.route = True
+        return super().send(request, **kwargs)
+
+
 class Api:
-    def __init__(self):
+    def __init__(self, pool_size: int = 16):
         self.cookies = None
 
-    def creators(self) -> dict:
-        res = requests.get(f"{base_url}/api/v1/creators.txt", headers=headers, hooks={"response": error_hooks})
+        self.limiter = RateLimiter()
+        self.cache = Cache()
+        self.mirrors = Mirrors(base_url, mirrors)
+        self.segment_size = None
+        self.segments = 4
+
+        # 全てのリクエストで接続を使い回すセッション (429/503はLimitedAdapterで再試行)
+        retry = CountingRetry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=[500, 502, 504],
+            raise_on_status=False,
+            respect_retry_after_header=False,
+        )
+        self.pool_size = pool_size
+        self.adapter = LimitedAdapter(
+            self.limiter, self.mirrors, pool_connections=8, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    # 同時に使う接続数がプールより多い場合は広げる (足りないと使い終わった接続が捨てられる)
+    def configure_pool(self, size: int):
+        if size <= self.pool_size:
+            return
+        self.pool_size = size
+        self.adapter.poolmanager.clear()
+        self.adapter.init_poolmanager(8, size)
+
+    # sizeを超えるファイルはconnections本の接続に分けてダウンロードする (Noneの場合は分割しない)
+    def configure_segments(self, size: int | None, connections: int):
+        self.segment_size = size if size and connections > 1 else None
+        self.segments = max(1, connections)
+
+    # 一覧に変更が無い場合はNone、ある場合はETag/Last-Modifiedと一覧を逐次返すイテレータ
+    def creators(self, etag: str | None = None, last_modified: str | None = None) -> tuple | None:
+        request_headers = dict(headers)
+        if etag is not None:
+            request_headers["If-None-Match"] = etag
+        if last_modified is not None:
+            request_headers["If-Modified-Since"] = last_modified
+        res = self.session.get(
+            f"{base_url}/api/v1/creators.txt", headers=request_headers, stream=True, hooks={"response": error_hooks}
+        )
+        if res.status_code == 304:
+            res.close()
+            return None
+        if res.status_code != 200:
+            res.close()
+            raise APIError(f"Failed to get creators list. ({res.status_code})")
         res.encoding = "utf-8"
-        return res.json()
+        return res.headers.get("ETag"), res.headers.get("Last-Modified"), iter_json(res)
+
+    # キャッシュがあればそれを返して、無ければ取得して保存する
+    def _get_json(self, url: str, params: dict | None = None):
+        key = self.cache.key(url, params)
+        if (data := self.cache.get(key)) is not None:
+            return data
+        res = self.session.get(url, params=params, headers=headers, hooks={"response": error_hooks})
+        data = res.json()
+        if res.status_code == 200:
+            self.cache.set(key, data)
+        return data
 
     def post(self, service: str, creator_id: int | str, post_id: int | str) -> dict:
-        res = requests.get(
-            f"{base_url}/api/v1/{service}/user/{creator_id}/post/{post_id}",
-            headers=headers,
-            hooks={"response": error_hooks},
-        )
-        return res.json()
+        return self._get_json(f"{base_url}/api/v1/{service}/user/{creator_id}/post/{post_id}")
 
     def creator(
         self, service: str, creator_id: int | str, offset: int | None, word: str | None, tag: str | None
     ) -> list:
-        res = requests.get(
-            f"{base_url}/api/v1/{service}/user/{creator_id}/posts",
-            params={"o": offset, "q": word, "tag": tag},
-            headers=headers,
-            hooks={"response": error_hooks},
+        return self._get_json(
+            f"{base_url}/api/v1/{service}/user/{creator_id}/posts", params={"o": offset, "q": word, "tag": tag}
         )
-        return res.json()
 
     def discord_server(self, discord_server: int | str) -> list:
-        res = requests.get(
-            f"{base_url}/api/v1/discord/channel/lookup/{discord_server}",
+        return self._get_json(f"{base_url}/api/v1/discord/channel/lookup/{discord_server}")
+
+    def discord_channel(self, channel_id: int | str, offset: int | None = None) -> list:
+        res = self.session.get(
+            f"{base_url}/api/v1/discord/channel/{channel_id}",
+            params={"o": offset},
             headers=headers,
             hooks={"response": error_hooks},
         )
         return res.json()
 
-    def discord_channel(self, channel_id: int | str, offset: int | None = None) -> list:
-        res = requests.get(f"{base_url}/api/v1/discord/channel/{channel_id}", params={"o": offset})
-        return res.json()
-
     def favorites(self, _type: str) -> list:
-        res = requests.get(
+        res = self.session.get(
             f"{base_url}/api/v1/account/favorites",
             params={"type": _type},
             headers=headers,
@@ -68,27 +249,225 @@ class Api:
         )
         return res.json()
 
-    def download(self, url, file):
-        retry = requests.adapters.Retry(total=5, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-        session = requests.Session()
-        session.mount("https://", requests.adapters.HTTPAdapter(max_retries=retry))
-        with session.get(
-            url,
-            stream=True,
-            headers={
-                "User-Agent": user_agent,
-                "Accept": "*/*",
-            },
-        ) as response:
-            with open(file, "wb") as f:
-                shutil.copyfileobj(response.raw, f)
-
-    def get_content(self, url):
-        res = requests.get(
-            url,
-            headers={
-                "User-Agent": user_agent,
-                "Accept": "*/*",
-            },
-        )
-        return res.content
+    # .partファイルに書き込み、サイズとハッシュを確認してからリネームする
+    def download(self, url, file, sha256: str | None = None, retries: int = 3):
+        part = file + ".part"
+        for i in range(retries):
+            try:
+                self._download(url, part, sha256)
+            except (IntegrityError, ProtocolError) as e:
+                metrics.retry(type(e).__name__)
+                if i == retries - 1:
+                    raise
+            else:
+                break
+        os.replace(part, file)
+
+    # 受信しながらバイト数とSHA-256を計算する (途中まである場合はRangeで再開)
+    def _download(self, url, part, sha256: str | None):
+        # 分割してダウンロードしている途中
+        if os.path.exists(part + ".json"):
+            self._download_segments(url, part, sha256)
+            return
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part):
+            with open(part, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    digest.update(chunk)
+                    offset = offset + len(chunk)
+        request_headers = {
+            "User-Agent": user_agent,
+            "Accept": "*/*",
+        }
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+        elif self.segment_size is not None:
+            # Rangeに対応しているかとサイズを最初の応答で確認する
+            request_headers["Range"] = "bytes=0-"
+        with self.session.get(url, stream=True, headers=request_headers) as response:
+            if response.status_code == 416:
+                # 既に全て受信済みかどうかを確認
+                m = re.fullmatch(r"bytes \*/(\d+)", response.headers.get("Content-Range", ""))
+                if m is None or int(m.group(1)) != offset:
+                    if os.path.exists(part):
+                        os.remove(part)
+                    response.raise_for_status()
+                total = offset
+                # 空のファイルはRangeで確認すると416になるので、.partが無ければここで作成する
+                open(part, "ab").close()
+            else:
+                response.raise_for_status()
+                if response.status_code == 206:
+                    m = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", response.headers.get("Content-Range", ""))
+                    if m is None or int(m.group(1)) != offset:
+                        if os.path.exists(part):
+                            os.remove(part)
+                        raise IntegrityError(f"Unexpected Content-Range: {url}")
+                    total = None if m.group(2) == "*" else int(m.group(2))
+                    if not offset and total is not None and self.segment_size is not None and total > self.segment_size:
+                        self._download_segments(url, part, sha256, total, response)
+                        return
+                    mode = "ab"
+                else:
+                    # Rangeが無視された場合は最初から書き直す
+                    digest = hashlib.sha256()
+                    offset = 0
+                    length = response.headers.get("Content-Length")
+                    total = int(length) if length is not None else None
+                    mode = "wb"
+                with open(part, mode) as f:
+                    for chunk in self._receive(response):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        offset = offset + len(chunk)
+        # 途中で切れた場合は.partを残して再開する
+        if total is not None and offset != total:
+            raise IntegrityError(f"Size mismatch ({offset}/{total}): {url}")
+        if sha256 is not None and digest.hexdigest() != sha256:
+            os.remove(part)
+            raise IntegrityError(f"SHA-256 mismatch: {url}")
+
+    # 大きなファイルは範囲に分けて、確保した.partの各位置に並行して書き込む
+    # 範囲毎の受信済みの位置は.part.jsonに保存して、中断した場合は残りから再開する
+    def _download_segments(self, url, part, sha256: str | None, total: int | None = None, response=None):
+        state = part + ".json"
+        if total is None:
+            with open(state, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            total = saved["total"]
+            ranges = saved["ranges"]
+        else:
+            # [受信済みの位置, 終了位置]
+            size = -(-total // self.segments)
+            ranges = [[start, min(start + size, total) - 1] for start in range(0, total, size)]
+            with open(part, "wb") as f:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, total)
+                except (AttributeError, OSError):
+                    f.truncate(total)
+        lock = threading.Lock()
+        saved = [time.monotonic()]
+
+        def save():
+            with lock:
+                saved[0] = time.monotonic()
+                with open(state + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump({"total": total, "ranges": ranges}, f)
+                os.replace(state + ".tmp", state)
+
+        def fetch(r: list, res=None):
+            if res is None:
+                res = self.session.get(
+                    url,
+                    stream=True,
+                    headers={"User-Agent": user_agent, "Accept": "*/*", "Range": f"bytes={r[0]}-{r[1]}"},
+                )
+            with res:
+                res.raise_for_status()
+                if res.status_code != 206:
+                    # Rangeに対応しなくなった場合は次の再試行で1本の接続でダウンロードする
+                    with lock:
+                        ranges.clear()
+                    raise IntegrityError(f"Range not supported: {url}")
+                m = re.fullmatch(r"bytes (\d+)-\d+/\d+", res.headers.get("Content-Range", ""))
+                if m is None or int(m.group(1)) != r[0]:
+                    raise IntegrityError(f"Unexpected Content-Range: {url}")
+                # 強制終了しても記録した位置までは書き込まれているようにバッファしない
+                with open(part, "r+b", buffering=0) as f:
+                    f.seek(r[0])
+                    for chunk in self._receive(res, r[1] + 1 - r[0]):
+                        f.write(chunk)
+                        r[0] = r[0] + len(chunk)
+                        if time.monotonic() - saved[0] >= 1.0:
+                            save()
+
+        save()
+        error = None
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            futures = [
+                executor.submit(fetch, r, response if i == 0 else None)
+                for i, r in enumerate(ranges)
+                if r[0] <= r[1]
+            ]
+            for future in futures:
+                try:
+                    future.result()
+                except (requests.exceptions.RequestException, IntegrityError, ProtocolError) as e:
+                    error = error or e
+        if not ranges:
+            for path in (part, state):
+                os.remove(path)
+            raise error
+        save()
+        if error is not None:
+            raise error
+        if any(r[0] <= r[1] for r in ranges):
+            raise IntegrityError(f"Size mismatch: {url}")
+
+        # 全ての範囲が揃ってからハッシュを確認する
+        if sha256 is not None:
+            digest = hashlib.sha256()
+            with open(part, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    digest.update(chunk)
+            if digest.hexdigest() != sha256:
+                for path in (part, state):
+                    os.remove(path)
+                raise IntegrityError(f"SHA-256 mismatch: {url}")
+        os.remove(state)
+
+    # 速度制限と計測を行いながら受信する (lengthを指定した場合はその分だけ)
+    def _receive(self, response, length: int | None = None):
+        # 最初に送ったミラー (データノードへのリダイレクト前) の転送速度として記録する
+        first = response.history[0] if response.history else response
+        endpoint = getattr(first, "mirror", None)
+        limiter = self.limiter.host(parse.urlparse(response.url).hostname)
+        received = 0
+        start = time.monotonic()
+        try:
+            for chunk in response.raw.stream(1024 * 64, decode_content=False):
+                if length is not None:
+                    chunk = chunk[: length - received]
+                limiter.consume(len(chunk))
+                metrics.add_bytes(len(chunk))
+                received = received + len(chunk)
+                yield chunk
+                if length is not None and received >= length:
+                    break
+        except ProtocolError:
+            if endpoint is not None:
+                self.mirrors.failed(endpoint)
+            raise
+        if endpoint is not None:
+            self.mirrors.transfer(endpoint, received, time.monotonic() - start)
+
+    # ページを先頭から受信してpatternが見つかった時点で切断する (404や上限まで見つからない場合はNone)
+    def scan(self, url: str, pattern: re.Pattern, limit: int = 4 * 1024 * 1024) -> re.Match | None:
+        with self.session.get(url, headers={"User-Agent": user_agent}, stream=True) as res:
+            if res.status_code == 404:
+                return None
+            res.raise_for_status()
+            res.encoding = "utf-8"
+            text = ""
+            for chunk in res.iter_content(chunk_size=65536, decode_unicode=True):
+                text = text + chunk
+                if m := pattern.search(text):
+                    return m
+                if len(text) > limit:
+                    break
+        return None
+
+    # lengthを指定した場合は先頭のみ取得する
+    def get_content(self, url, length: int | None = None):
+        request_headers = {
+            "User-Agent": user_agent,
+            "Accept": "*/*",
+        }
+        if length is None:
+            res = self.session.get(url, headers=request_headers)
+            return res.content
+        request_headers["Range"] = f"bytes=0-{length - 1}"
+        with self.session.get(url, headers=request_headers, stream=True) as res:
+            # Rangeが無視された場合も先頭だけ読んで切断する
+            return res.raw.read(length, decode_content=True)
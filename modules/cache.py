@@ -0,0 +1,97 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+# APIのレスポンスを保存する期限付きキャッシュ
+class Cache:
+    def __init__(self, path: str = "cache.db", ttl: float = 600, max_size: int = 256 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.enabled = True
+        self.lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS resolved (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    def configure(self, enabled: bool, ttl: float | None = None):
+        self.enabled = enabled
+        if ttl is not None:
+            self.ttl = ttl
+
+    # エンドポイントとパラメータからキーを作成 (Noneのパラメータは送信されないので除く)
+    @staticmethod
+    def key(url: str, params: dict | None = None) -> str:
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        return url + "?" + json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, key: str, value):
+        if not self.enabled:
+            return
+        data = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, data, len(data), now, now))
+            self._evict(now)
+            self.conn.commit()
+
+    # 期限切れを削除して、上限を超えた場合は古く使われたものから削除
+    def _evict(self, now: float):
+        self.conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total = total - size
+            if total <= self.max_size:
+                break
+
+    # 外部サイトのURLから解決したIDは変わらないので期限無しで保存する
+    def resolved(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM resolved WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_resolved(self, key: str, value: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO resolved VALUES (?, ?)", (key, value))
+            self.conn.commit()
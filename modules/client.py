@@ -1,149 +1,508 @@
+import errno
 import io
-import json
-import math
 import os
+import queue
+import threading
 from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from zipfile import BadZipFile
 
-from PIL import Image, UnidentifiedImageError
-from tqdm import tqdm
-from urllib3.exceptions import ProtocolError
-
 from . import global_var
 from .global_var import domain, base_url
-from .api import Api
-from .common import Color, Table, logger
+from .creators import Creators
+from .journal import Journal
+from .ledger import Ledger
+from .metrics import metrics
+from .stage import Stage
+from .store import Store, path_hash
+from .common import Color, Table, convert_size, image_size, logger
+
+
+# discordのチャンネルの1ページあたりのメッセージ数と先読みするページ数
+discord_page = 150
+discord_prefetch = 4
+
+folder_name = str.maketrans(
+    {
+        "　": " ",
+        "\\": "＼",
+        "/": "／",
+        ":": "：",
+        "*": "＊",
+        "?": "？",
+        '"': "”",
+        "<": "＜",
+        ">": "＞",
+        "|": "｜",
+    }
+)
 
 
+# requests, PIL, tqdmは読み込みに時間が掛かるので、使う処理の中でimportする
 class Client:
     def __init__(self):
-        self.api = Api()
-        self.deque = deque()
+        self._api = None
+        self.store = Store()
+        self._phash = None
+        self.similar = []
+        self.ledger = Ledger()
+        self.journal = Journal()
+        self.queue = queue.Queue(maxsize=100)
+        self.producer_error = None
+        self._creators = Creators()
+        self.creators_lock = threading.Lock()
+        self.creators_loaded = False
+        self.marks = []
+        self.stages = []
         self.logged = False
 
-        self.creators(False)
-
-    # キューをダウンロード
-    def download(self):
-        def convert_size(size):
-            units = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB")
-            i = math.floor(math.log(size, 1024)) if size > 0 else 0
-            size = round(size / 1024**i, 2)
-
-            return f"{size} {units[i]}"
-
-        folder_name = str.maketrans(
-            {
-                "　": " ",
-                "\\": "＼",
-                "/": "／",
-                ":": "：",
-                "*": "＊",
-                "?": "？",
-                '"': "”",
-                "<": "＜",
-                ">": "＞",
-                "|": "｜",
-            }
-        )
+    # 知覚ハッシュの索引 (numpyを使うので必要になった時に読み込む)
+    @property
+    def phash(self):
+        if self._phash is None:
+            from .phash import PHashIndex
 
-        dsize = len(self.deque)
-        if not dsize:
-            Color.warn("There is nothing in the queue.")
-            return
+            self._phash = PHashIndex()
+        return self._phash
 
-        table = Table()
-        table.add_column("Title")
-        table.add_column("ID")
-        table.add_column("Attachments")
+    # セッションはAPIへのリクエストが必要になった時に作成する
+    @property
+    def api(self):
+        if self._api is None:
+            from .api import Api
 
-        for v in list(self.deque):
-            table.add_row(v["title"], v["post_id"], str(len(v["attachments"])))
+            self._api = Api()
+        return self._api
 
-        table.print()
-        print()
+    # 投稿の列挙とダウンロードを並行して行う (複数のurlは同じキューにまとめる)
+    def download(self, *producers) -> dict:
+        from requests import RequestException
+        from tqdm import tqdm
 
-        file_num = 0
-        file_size = 0
-        print("Download started.")
-        if dsize != 1:
-            qbar = tqdm(range(dsize), "Queue", leave=False)
-        for i in range(dsize):
-            data = self.deque.popleft()
-            # フォルダ名に使えない文字を置換、スペースを除去
-            path = os.path.join(
-                "./img",
-                data["service"],
-                f"[{data['creator_id']}] {data['creator_name'].translate(folder_name).strip()}",
-                f"[{data['post_id']}] {data['title'].translate(folder_name).strip()}",
+        from .api import APIError
+
+        # 失敗したユーザー/投稿だけ飛ばして他の列挙とダウンロードは続ける
+        def run(producer):
+            try:
+                with metrics.phase("enumerate"):
+                    producer()
+            except APIError as e:
+                metrics.failure(type(e).__name__)
+                Color.error(str(e))
+            # 通信/解析の失敗や想定外のエラーもこのurlだけ飛ばす
+            except Exception as e:
+                metrics.failure(type(e).__name__)
+                name = " ".join(str(arg) for arg in getattr(producer, "args", ()))
+                logger.debug(f"{name}: {type(e).__name__}: {e}", exc_info=not isinstance(e, RequestException))
+                Color.error(f"{name}: {type(e).__name__}: {e}")
+
+        def produce():
+            try:
+                with ThreadPoolExecutor(max_workers=min(4, len(producers))) as executor:
+                    for future in [executor.submit(run, producer) for producer in producers]:
+                        future.result()
+            except BaseException as e:
+                self.producer_error = e
+            finally:
+                self.queue.put(None)
+
+        # 後処理はダウンロードと並行して別プロセスで行う
+        self.stages = []
+        if global_var.args.extract:
+            from .extract import extract
+
+            self.stages.append(
+                Stage(
+                    "extract",
+                    extract,
+                    ["archive"],
+                    self.ledger,
+                    global_var.args.extract_jobs,
+                    global_var.args.extract_memory,
+                )
             )
-            if global_var.args.flat:
-                path = os.path.dirname(path)
-            if not os.path.exists(path):
-                os.makedirs(path, exist_ok=True)
-            for attachment in tqdm(data["attachments"], "Attachments", leave=False):
-                file = os.path.join(path, attachment["name"])
-                if os.path.exists(file):
-                    logger.debug("skip: " + file)
-                    continue
-                _type = attachment["type"]
+        if global_var.args.preview:
+            from .preview import preview
+
+            self.stages.append(
+                Stage(
+                    "preview",
+                    preview,
+                    ["psd", "image"],
+                    self.ledger,
+                    global_var.args.preview_jobs,
+                    global_var.args.preview_memory,
+                )
+            )
+
+        self.similar = []
+        # 再開できるように実行時の引数を記録する
+        self.journal.start({k: v for k, v in vars(global_var.args).items() if not callable(v)})
+        self.producer_error = None
+        jobs = max(1, global_var.args.jobs)
+        # ダウンロード (分割する場合は接続数倍) と列挙、discordの先読みで同時に使う接続数
+        # (プールを作り直すので列挙を始める前に行う)
+        segments = self.api.segments if self.api.segment_size is not None else 1
+        self.api.configure_pool(jobs * segments + 4 + discord_prefetch)
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        result = {"posts": 0, "files": 0, "size": 0, "linked": 0, "failed": 0}
+        queued = set()
+        completed = {}
+        pending = set()
+        print("Download started.")
+        with metrics.phase("download"), tqdm(total=0, desc="Download", unit="file", leave=False) as pbar:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
                 try:
-                    self.api.download(attachment["url"], file)
-                    # ファイル破損チェック
-                    if _type == "image":
-                        Image.open(file)
-                    file_num = file_num + 1
-                    file_size = file_size + os.path.getsize(file)
-                    logger.debug("download: " + file)
-                # ファイルが破損していた場合削除
-                except (ProtocolError, UnidentifiedImageError, BadZipFile, ConnectionError):
-                    os.remove(file)
-                except FileNotFoundError:
-                    logger.debug("notfound: " + file)
+                    while (data := self.queue.get()) is not None:
+                        result["posts"] = result["posts"] + 1
+                        tqdm.write(f"[{data['post_id']}] {data['title']} ({len(data['attachments'])})")
+                        metrics.queue_depth(self.queue.qsize(), len(pending))
+                        for task in self._prepare(data, completed, queued, result):
+                            # 処理中のファイル数を制限して列挙側を待たせる
+                            if len(pending) >= jobs * 2:
+                                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                                self._collect(done, result, pbar)
+                            pending.add(executor.submit(self._download_attachment, *task))
+                            pbar.total = pbar.total + 1
+                            pbar.refresh()
+                    done, pending = wait(pending)
+                    self._collect(done, result, pbar)
                 except OSError as e:
-                    logger.debug(type(e))
-                    logger.debug(str(e))
                     # 空き容量が無い場合は終了
-                    if str(e) == "[Errno 28] No space left on device":
-                        Color.warn("No space left on device")
-                        input()
-                        exit()
-            # time.sleep(1)
-            if dsize != 1:
-                qbar.update(1)
-        if dsize != 1:
-            qbar.close()
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    for stage in self.stages:
+                        stage.shutdown(cancel=True)
+                    pbar.close()
+                    self.ledger.flush()
+                    Color.warn("No space left on device")
+                    input()
+                    exit()
+        thread.join()
+        for stage in self.stages:
+            stage.shutdown()
+            result[stage.name] = stage.result
+        self.journal.compact()
+        if self.producer_error is not None:
+            self.ledger.flush()
+            raise self.producer_error
+
+        if not result["posts"]:
+            self.save_marks()
+            Color.warn("There is nothing in the queue.")
+            return result
+
+        # 失敗したファイルが無い場合のみ同期位置を進める
+        if not result["failed"]:
+            self.save_marks()
+        self.marks = []
+        self.ledger.flush()
+        self.store.save()
 
         table = Table()
+        table.add_column("Posts")
         table.add_column("Files")
         table.add_column("Size")
-        table.add_row(str(file_num), convert_size(file_size))
+        table.add_column("Linked")
+        table.add_column("Failed")
+        table.add_row(
+            str(result["posts"]),
+            str(result["files"]),
+            convert_size(result["size"]),
+            str(result["linked"]),
+            str(result["failed"]),
+        )
         table.print()
 
+        if self.stages:
+            table = Table()
+            table.add_column("Stage")
+            table.add_column("Done")
+            table.add_column("Skipped")
+            table.add_column("Failed")
+            for stage in self.stages:
+                table.add_row(
+                    stage.name, str(stage.result["done"]), str(stage.result["skipped"]), str(stage.result["failed"])
+                )
+            table.print()
+
+        if self.api.mirrors.enabled and self.api.mirrors.probed:
+            table = Table()
+            table.add_column("Mirror")
+            table.add_column("Latency")
+            table.add_column("Speed")
+            table.add_column("Failures")
+            for netloc, latency, throughput, failures, healthy in self.api.mirrors.report():
+                table.add_row(
+                    netloc if healthy else f"{netloc} (down)",
+                    "-" if latency is None else f"{latency * 1000:.0f}ms",
+                    "-" if throughput is None else f"{convert_size(throughput)}/s",
+                    str(failures),
+                )
+            table.print()
+
+        if self.similar:
+            table = Table()
+            table.add_column("Distance")
+            table.add_column("File")
+            table.add_column("Similar to")
+            for file, other, distance in sorted(self.similar, key=lambda x: x[2]):
+                table.add_row(str(distance), file, os.path.relpath(other))
+            table.print()
+            if global_var.args.skip_similar:
+                Color.warn(f"{len(self.similar)} similar images were removed.")
+
         Color.info("Download completed.")
+        return result
+
+    # 投稿からダウンロードするファイルを列挙、台帳に完了済みとあるファイルはスキップ
+    def _prepare(self, data: dict, completed: dict, queued: set, result: dict) -> list:
+        key = (data["service"], str(data["creator_id"]))
+        if key not in completed:
+            completed[key] = self.ledger.completed(*key)
+        attachments = []
+        finished = []
+        for attachment in data["attachments"]:
+            _hash = attachment["hash"] if attachment["hash"] is not None else attachment["name"]
+            if (str(data["post_id"]), _hash) in completed[key]:
+                self._ack(data, attachment)
+                finished.append(attachment)
+                continue
+            attachments.append(attachment)
+        if not attachments and not self.stages:
+            return []
+        # フォルダ名に使えない文字を置換、スペースを除去
+        path = os.path.join(
+            "./img",
+            data["service"],
+            f"[{data['creator_id']}] {data['creator_name'].translate(folder_name).strip()}",
+            f"[{data['post_id']}] {data['title'].translate(folder_name).strip()}",
+        )
+        if global_var.args.flat:
+            path = os.path.dirname(path)
+        # 以前に後処理無しでダウンロードしたファイルも後処理に渡す
+        for attachment in finished:
+            file = os.path.join(path, attachment["name"])
+            if os.path.exists(file):
+                self._post_process(attachment, file)
+        if not attachments:
+            return []
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        tasks = []
+        for attachment in attachments:
+            file = os.path.join(path, attachment["name"])
+            # 同じ実行で既に予定しているファイル
+            if file in queued:
+                self._ack(data, attachment)
+                continue
+            # 台帳に記録される前にダウンロードしたファイル
+            if os.path.exists(file):
+                logger.debug("skip: " + file)
+                self._record(data, attachment, file, os.path.getsize(file))
+                self._post_process(attachment, file)
+                continue
+            queued.add(file)
+            # 同じハッシュのファイルが既にあればリンクする
+            if attachment["hash"] is not None and self.store.link(attachment["hash"], file):
+                logger.debug("link: " + file)
+                self._record(data, attachment, file, os.path.getsize(file))
+                result["linked"] = result["linked"] + 1
+                self._post_process(attachment, file)
+                continue
+            tasks.append((data, attachment, file))
+        return tasks
+
+    # 台帳に記録して、ジャーナルの添付ファイルを完了済みにする
+    def _record(self, data: dict, attachment: dict, file: str, size: int, status: str = "complete"):
+        self.ledger.record(data, attachment, file, size, status)
+        # 失敗したファイルはresumeで再試行できるようにジャーナルに残す
+        if status != "failed":
+            self._ack(data, attachment)
+
+    def _ack(self, data: dict, attachment: dict):
+        if "job" in data:
+            self.journal.ack(data["job"], attachment["hash"] or attachment["name"])
+
+    # ジャーナルに記録してからキューに追加する (キューが一杯の場合はダウンロードが進むまで待つ)
+    def _enqueue(self, data: dict):
+        data["job"] = self.journal.add(data)
+        self.queue.put(data)
+
+    # 中断した実行で残った投稿をAPIを使わずにキューに戻す
+    def resume(self, pending: list):
+        for data in pending:
+            self.queue.put(data)
+
+    # 完了したダウンロードを集計
+    def _collect(self, done: set, result: dict, pbar):
+        for future in done:
+            size = future.result()
+            if size is not None:
+                result["files"] = result["files"] + 1
+                result["size"] = result["size"] + size
+            else:
+                result["failed"] = result["failed"] + 1
+            pbar.update(1)
+
+    # 知覚ハッシュを索引に登録して、似た画像があればそのパスを返す (--skip-similarの場合は登録しない)
+    def _check_similar(self, attachment: dict, file: str) -> str | None:
+        from PIL import Image, UnidentifiedImageError
+
+        from .phash import dhash
+
+        # 開けない画像や大きすぎる画像 (DecompressionBombError) は比較しない
+        try:
+            value = dhash(file)
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+            logger.debug(f"phash: skip {file} {type(e).__name__}: {e}")
+            return None
+        with self.phash.lock:
+            match = self.phash.find(value, attachment["hash"], global_var.args.distance, os.path.abspath(file))
+            if match is not None:
+                self.similar.append((file, *match))
+            if match is None or not global_var.args.skip_similar:
+                self.phash.add(file, attachment["hash"], value)
+        return None if match is None else match[0]
+
+    # img内の未登録または更新された画像を索引に登録
+    def index_images(self, root: str = "./img") -> int:
+        from tqdm import tqdm
+
+        from .phash import dhash
+
+        def work(file):
+            try:
+                return dhash(file)
+            except Exception as e:
+                logger.debug(f"phash: {file} {type(e).__name__}: {e}")
+                return None
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            # .store/.previewは除く
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for name in filenames:
+                if os.path.splitext(name)[1][1:].lower() in global_var.types["image"]["ext"]:
+                    files.append(os.path.join(dirpath, name))
+        files = [file for file in files if not self.phash.indexed(file)]
+        count = 0
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+            for file, value in tqdm(zip(files, executor.map(work, files)), total=len(files), desc="Index", leave=False):
+                if value is not None:
+                    self.phash.add(file, path_hash(file), value)
+                    count = count + 1
+        return count
+
+    # 後処理が有効な場合は完了したファイルを渡す
+    def _post_process(self, attachment: dict, file: str):
+        for stage in self.stages:
+            if attachment["type"] in stage.types:
+                stage.submit(file)
+
+    # 同期位置を保存
+    def save_marks(self):
+        for mark in self.marks:
+            self.ledger.set_mark(*mark)
+        self.marks = []
+
+    # 添付ファイルを一件ダウンロード、成功した場合はファイルサイズを返す
+    def _download_attachment(self, data: dict, attachment: dict, file: str) -> int | None:
+        from PIL import Image, UnidentifiedImageError
+        from urllib3.exceptions import ProtocolError
+
+        from .api import IntegrityError
+
+        _type = attachment["type"]
+        try:
+            self.api.download(attachment["url"], file, attachment["hash"])
+            # ハッシュが分からない場合のみファイル破損チェック
+            if _type == "image" and attachment["hash"] is None:
+                with Image.open(file):
+                    pass
+            if _type == "image" and (global_var.args.phash or global_var.args.skip_similar):
+                # 似た画像がある場合はそのパスを記録して削除
+                if (other := self._check_similar(attachment, file)) is not None and global_var.args.skip_similar:
+                    os.remove(file)
+                    self._record(data, attachment, other, 0, "similar")
+                    return 0
+            if attachment["hash"] is not None:
+                self.store.add(attachment["hash"], file)
+            logger.debug("download: " + file)
+            size = os.path.getsize(file)
+            self._record(data, attachment, file, size)
+            self._post_process(attachment, file)
+            return size
+        # ファイルが破損していた場合削除
+        except (ProtocolError, IntegrityError, UnidentifiedImageError, BadZipFile, ConnectionError) as e:
+            metrics.failure(type(e).__name__)
+            if os.path.exists(file):
+                os.remove(file)
+        except FileNotFoundError:
+            metrics.failure("FileNotFoundError")
+            logger.debug("notfound: " + file)
+        except OSError as e:
+            metrics.failure(type(e).__name__)
+            logger.debug(type(e))
+            logger.debug(str(e))
+            if e.errno == errno.ENOSPC:
+                raise
+        self._record(data, attachment, file, 0, "failed")
+        return None
+
+    # サムネイルの先頭だけを取得して、カバー画像 (800x420以外) かどうか判定する
+    def detect_cover(self, path: str) -> bool | None:
+        from PIL import Image, UnidentifiedImageError
+
+        url = f"https://img.{domain}/thumbnail/data/{path}"
+        size = image_size(self.api.get_content(url, 64 * 1024))
+        if size is None:
+            try:
+                with Image.open(io.BytesIO(self.api.get_content(url))) as img:
+                    size = img.size
+            except UnidentifiedImageError as e:
+                logger.debug(str(e))
+                logger.debug(url)
+                return None
+        return (800, 420) != size
 
     # 投稿の解析
     def parse(self, post: dict, bw=None, cover=False):
+        with metrics.phase("parse"):
+            data = self._parse(post, bw, cover)
+        if data is not None:
+            self._enqueue(data)
+
+    def _parse(self, post: dict, bw=None, cover=False) -> dict | None:
         title = post["title"]
         if bw is not None and bw.lower() in title.lower():
-            return
+            return None
         creator_id = post["user"]
         post_id = post["id"]
         attachments = list()
         page = 0
-        if cover:
-            url = os.path.join(f"https://img.{domain}/thumbnail/data/{post['file']['path']}")
-            try:
-                img = Image.open(io.BytesIO(self.api.get_content(url)))
-            except UnidentifiedImageError as e:
-                logger.debug(str(e))
-                logger.debug(url)
-            else:
-                if (800, 420) != img.size:
-                    ext = os.path.splitext(post["file"]["name"])[1]
-                    url = f"{base_url}/data/{post['file']['path']}"
-                    attachments.append({"name": f"{post_id}_p{page}{ext}", "url": url, "type": "image"})
-                    page = page + 1
+        if cover and post["file"]:
+            # 判定結果は投稿毎に保存しておく
+            has_cover = self.ledger.cover(post["service"], post_id)
+            if has_cover is None:
+                has_cover = self.detect_cover(post["file"]["path"])
+                if has_cover is not None:
+                    self.ledger.set_cover(post["service"], post_id, has_cover)
+            if has_cover:
+                ext = os.path.splitext(post["file"]["name"])[1]
+                url = f"{base_url}/data/{post['file']['path']}"
+                attachments.append(
+                    {
+                        "name": f"{post_id}_p{page}{ext}",
+                        "url": url,
+                        "type": "image",
+                        "hash": path_hash(post["file"]["path"]),
+                    }
+                )
+                page = page + 1
         for attachment in post["attachments"]:
             basename = attachment["name"]
             ext = os.path.splitext(basename)[1][1:]
@@ -159,86 +518,115 @@ class Client:
                 basename = f"{post_id}_p{page}.{ext}"
                 page = page + 1
             url = f"{base_url}/data/{attachment['path']}"
-            attachments.append({"name": basename, "url": url, "type": _type})
+            attachments.append({"name": basename, "url": url, "type": _type, "hash": path_hash(attachment["path"])})
         if len(attachments) == 0:
-            return
+            return None
         data = {
             "title": title,
             "creator_id": creator_id,
-            "creator_name": self.creator_info(creator_id)["name"],
+            "creator_name": self.creator_info(creator_id, post["service"]).get("name", str(creator_id)),
             "post_id": post_id,
             "service": post["service"],
             "attachments": attachments,
         }
-        self.deque.append(data)
-
-    # ユーザー一覧を更新、読込
-    def creators(self, update: bool):
-        if not os.path.exists("creators.json") or update:
-            creators = {}
-            for creator in self.api.creators():
-                id = creator["id"]
-                creators[id] = creator
-            self._creators = creators
-            with open("creators.json", "w", encoding="utf-8") as f:
-                json.dump(self._creators, f, ensure_ascii=False, indent=4)
-        else:
-            self._creators = json.load(open("creators.json", "r", encoding="utf-8"))
+        return data
+
+    # ユーザー一覧を更新 (一覧が無い場合は取得、旧形式があれば取り込む)
+    def creators(self, update: bool) -> dict | None:
+        # 前回の取得に失敗して空のまま残っている場合も取得し直す
+        empty = not len(self._creators)
+        if not update and (not empty or self._creators.migrate()):
+            return None
+        # 変更が無い場合はNone (空の場合は条件を付けずに取得)
+        result = self.api.creators(*(self._creators.validators() if not empty else (None, None)))
+        if result is None:
+            return None
+        etag, last_modified, creators = result
+        return self._creators.replace(creators, etag, last_modified)
+
+    # ユーザー一覧は最初に使う時に用意する (使わないサブコマンドで開いたり取得したりしない)
+    def _load_creators(self):
+        with self.creators_lock:
+            if not self.creators_loaded:
+                self.creators(False)
+                self.creators_loaded = True
 
     # ユーザー情報を取得
-    def creator_info(self, creator_id: int | str) -> dict:
-        try:
-            creator = self._creators[creator_id]
-        except KeyError:
-            return dict()
-        else:
-            return creator
+    def creator_info(self, creator_id: int | str, service: str | None = None) -> dict:
+        self._load_creators()
+        return self._creators.get(creator_id, service)
 
     # ユーザーを検索
-    def search_creator(self, word: str, service: str | None):
+    def search_creator(self, word: str, service: str | None, limit: int | None = None):
         creators_data = []
-        for creator in self._creators.values():
-            name = creator["name"]
+        self._load_creators()
+        for creator in self._creators.search(word, service, limit):
+            _id = creator["id"]
             _service = creator["service"]
-            if service is None:
-                pass
-            elif service != _service:
-                continue
-            if word.lower() in name.lower():
-                _id = creator["id"]
-                creator_data = {
-                    "name": name,
-                    "id": _id,
-                    "service": _service,
-                    "url": (
-                        f"{base_url}/{_service}/user/{_id}"
-                        if _service != "discord"
-                        else f"{base_url}/{_service}/server/{_id}"
-                    ),
-                }
-                creators_data.append(creator_data)
+            creator_data = {
+                "name": creator["name"],
+                "id": _id,
+                "service": _service,
+                "url": (
+                    f"{base_url}/{_service}/user/{_id}"
+                    if _service != "discord"
+                    else f"{base_url}/{_service}/server/{_id}"
+                ),
+            }
+            creators_data.append(creator_data)
 
         return creators_data
 
     def creator(self, service: str, creator_id: int | str):
-        _creator = self.creator_info(creator_id)
-        print(f"{_creator['name']}@{_creator['service']}[{_creator['id']}]")
+        _creator = self.creator_info(creator_id, service)
         if _creator:
+            print(f"{_creator['name']}@{_creator['service']}[{_creator['id']}]")
             offset = 0 if global_var.args.page is None else (global_var.args.page - 1) * 50
             word = None if global_var.args.word is None else global_var.args.word + " "
             tag = None if global_var.args.tag is None else global_var.args.tag
+            # 前回同期した投稿まで到達したら終了する
+            mark = None
+            if not global_var.args.full and global_var.args.page is None:
+                mark = self.ledger.mark(service, creator_id)
+            newest = None
+            synced = False
             while True:
                 posts = self.api.creator(service, creator_id, offset=offset, word=word, tag=tag)
                 for post in posts:
+                    if mark is not None and self.reached(post, mark):
+                        synced = True
+                        break
+                    if newest is None:
+                        newest = post
                     self.parse(post, bw=global_var.args.block_word, cover=global_var.args.cover)
+                if synced:
+                    break
                 if len(posts) < 50:
                     break
                 if global_var.args.page is not None:
                     break
                 offset = offset + 50
+            if synced and newest is None:
+                Color.info("No new posts.")
+            # 絞り込みが無い場合のみ同期位置を更新する
+            filtered = any(
+                [global_var.args.page, global_var.args.word, global_var.args.tag, global_var.args.block_word]
+            )
+            if newest is not None and not filtered and not global_var.enable_filter:
+                self.marks.append((service, creator_id, newest["id"], newest.get("published")))
         else:
             Color.warn("Not found.")
 
+    # 前回同期した投稿かどうか
+    @staticmethod
+    def reached(post: dict, mark: tuple) -> bool:
+        post_id, published = mark
+        if str(post["id"]) == post_id:
+            return True
+        if published is not None and post.get("published") is not None:
+            return post["published"] <= published
+        return False
+
     def post(self, service: str, creator_id: int | str, post_id: int | str):
         _post = self.api.post(service, creator_id, post_id)
         if _post == {"error": "Not Found"}:
@@ -246,7 +634,7 @@ class Client:
             return
         self.parse(_post["post"], cover=global_var.args.cover)
 
-    # チャンネル一覧を表示
+    # チャンネル一覧を表示して、全てのチャンネルをダウンロード
     def discord_server(self, discord_server: int | str):
         channels = self.api.discord_server(discord_server)
         if channels:
@@ -256,8 +644,84 @@ class Client:
             for channel in channels:
                 table.add_row("#" + channel["name"], channel["id"])
             table.print()
+            for channel in channels:
+                self.discord_channel(discord_server, channel["id"], channel["name"])
         else:
             Color.warn("Not found.")
 
-    def discord_channel(self, channel_id: int | str):
-        pass
+    # メッセージを新しい順に取得する (次のページを並行して先読みし、前回同期したメッセージまで到達したら終了)
+    def discord_channel(self, server_id: int | str, channel_id: int | str, channel_name: str | None = None):
+        if channel_name is None:
+            channels = {str(c["id"]): c["name"] for c in self.api.discord_server(server_id)}
+            channel_name = channels.get(str(channel_id), str(channel_id))
+        server_name = self.creator_info(server_id, "discord").get("name", str(server_id))
+        print(f"#{channel_name}@{server_name}[{channel_id}]")
+
+        mark = None
+        if not global_var.args.full:
+            mark = self.ledger.mark("discord", channel_id)
+        newest = None
+        synced = False
+        with ThreadPoolExecutor(max_workers=discord_prefetch) as executor:
+            pages = deque(
+                executor.submit(self.api.discord_channel, channel_id, i * discord_page) for i in range(discord_prefetch)
+            )
+            offset = discord_prefetch * discord_page
+            while pages:
+                messages = pages.popleft().result()
+                for message in messages:
+                    if mark is not None and self.reached(message, mark):
+                        synced = True
+                        break
+                    if newest is None:
+                        newest = message
+                    with metrics.phase("parse"):
+                        data = self._parse_message(message, server_id, server_name, channel_id, channel_name)
+                    if data is not None:
+                        self._enqueue(data)
+                if synced or len(messages) < discord_page:
+                    break
+                pages.append(executor.submit(self.api.discord_channel, channel_id, offset))
+                offset = offset + discord_page
+            # 不要になった先読みは取り消す
+            for page in pages:
+                page.cancel()
+        if synced and newest is None:
+            Color.info("No new messages.")
+        filtered = global_var.args.block_word is not None or global_var.enable_filter
+        if newest is not None and not filtered:
+            self.marks.append(("discord", channel_id, newest["id"], newest.get("published")))
+
+    # メッセージの添付ファイルをチャンネル毎のフォルダにまとめる (同名のファイルが多いのでメッセージIDを付ける)
+    def _parse_message(
+        self, message: dict, server_id: int | str, server_name: str, channel_id: int | str, channel_name: str
+    ) -> dict | None:
+        bw = global_var.args.block_word
+        if bw is not None and bw.lower() in (message.get("content") or "").lower():
+            return None
+        attachments = []
+        for attachment in message.get("attachments", []):
+            ext = os.path.splitext(attachment["name"])[1][1:].lower()
+            if ext not in global_var.exts.keys():
+                continue
+            _type = global_var.exts[ext]
+            if global_var.enable_filter and not global_var.args_dict[_type]:
+                continue
+            attachments.append(
+                {
+                    "name": f"{message['id']}_{attachment['name']}",
+                    "url": f"{base_url}/data{attachment['path']}",
+                    "type": _type,
+                    "hash": path_hash(attachment["path"]),
+                }
+            )
+        if not attachments:
+            return None
+        return {
+            "title": "#" + channel_name,
+            "creator_id": server_id,
+            "creator_name": server_name,
+            "post_id": channel_id,
+            "service": "discord",
+            "attachments": attachments,
+        }
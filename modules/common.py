@@ -1,3 +1,5 @@
+import math
+import struct
 import unicodedata
 from logging import DEBUG, FileHandler, Formatter, getLogger
 
@@ -94,11 +96,54 @@ class Table:
             print(self.grid(row))
 
 
+def convert_size(size):
+    units = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB")
+    i = math.floor(math.log(size, 1024)) if size > 0 else 0
+    size = round(size / 1024**i, 2)
+
+    return f"{size} {units[i]}"
+
+
+# 画像のヘッダーから幅と高さを取得 (PNG, GIF, JPEG, WebP)
+def image_size(data: bytes) -> tuple | None:
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        return None
+    if data[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 9 <= len(data):
+            if data[pos] != 0xFF:
+                return None
+            marker = data[pos + 1]
+            # SOFマーカー (DHT, JPG, DACを除く)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[pos + 5 : pos + 9])
+                return width, height
+            if marker == 0xFF:
+                pos = pos + 1
+                continue
+            pos = pos + 2 + struct.unpack(">H", data[pos + 2 : pos + 4])[0]
+    return None
+
+
 def make_logger(name):
     logger = getLogger(name)
     logger.setLevel(DEBUG)
 
-    fl_handler = FileHandler(filename=".log", encoding="utf-8", mode="w")
+    # 後処理のワーカープロセスがimportしただけでログを消さないように、最初の書き込みまで開かない
+    fl_handler = FileHandler(filename=".log", encoding="utf-8", mode="w", delay=True)
     fl_handler.setLevel(DEBUG)
     fl_handler.setFormatter(Formatter("[{levelname}] {asctime} [{filename}:{lineno}] {message}", style="{"))
     logger.addHandler(fl_handler)
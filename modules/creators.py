@@ -0,0 +1,149 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+# ユーザー一覧のデータベース
+class Creators:
+    def __init__(self, path: str = "creators.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn = None
+        self._fts = False
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS creators (
+                    id TEXT NOT NULL,
+                    service TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    name_lower TEXT NOT NULL,
+                    indexed INTEGER,
+                    updated INTEGER,
+                    favorited INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (service, id)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS creators_id ON creators (id)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # 部分一致検索用のトライグラム索引 (使えない場合は全件走査)
+            try:
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS creators_fts "
+                    "USING fts5(name, content='creators', content_rowid='rowid', tokenize='trigram')"
+                )
+                self._fts = True
+            except sqlite3.OperationalError:
+                self._fts = False
+            self._conn.commit()
+        return self._conn
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM creators").fetchone()[0]
+
+    # 前回取得時のETag/Last-Modified
+    def validators(self) -> tuple:
+        with self.lock:
+            rows = dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+        return rows.get("etag"), rows.get("last_modified")
+
+    # 一覧を入れ替えて、追加、削除、名前変更された数を返す
+    def replace(self, creators, etag: str | None = None, last_modified: str | None = None) -> dict:
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS temp.staging")
+                self.conn.execute(
+                    "CREATE TEMP TABLE staging AS SELECT id, service, name, name_lower, indexed, updated, favorited "
+                    "FROM creators WHERE 0"
+                )
+                self.conn.execute("CREATE UNIQUE INDEX temp.staging_key ON staging (service, id)")
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO staging VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        (
+                            str(creator["id"]),
+                            creator["service"],
+                            creator["name"],
+                            creator["name"].lower(),
+                            creator.get("indexed"),
+                            creator.get("updated"),
+                            creator.get("favorited") or 0,
+                        )
+                        for creator in creators
+                    ),
+                )
+                summary = {
+                    "added": self.conn.execute(
+                        "SELECT COUNT(*) FROM staging s WHERE NOT EXISTS "
+                        "(SELECT 1 FROM creators c WHERE c.service = s.service AND c.id = s.id)"
+                    ).fetchone()[0],
+                    "removed": self.conn.execute(
+                        "SELECT COUNT(*) FROM creators c WHERE NOT EXISTS "
+                        "(SELECT 1 FROM staging s WHERE s.service = c.service AND s.id = c.id)"
+                    ).fetchone()[0],
+                    "renamed": self.conn.execute(
+                        "SELECT COUNT(*) FROM staging s JOIN creators c ON c.service = s.service AND c.id = s.id "
+                        "WHERE c.name != s.name"
+                    ).fetchone()[0],
+                }
+                self.conn.execute("DELETE FROM creators")
+                self.conn.execute("INSERT INTO creators SELECT * FROM staging")
+                self.conn.execute("DROP TABLE temp.staging")
+                if self._fts:
+                    self.conn.execute("INSERT INTO creators_fts(creators_fts) VALUES ('rebuild')")
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)", (("etag", etag), ("last_modified", last_modified))
+                )
+        return summary
+
+    # 旧形式のcreators.jsonを取り込む
+    def migrate(self, path: str = "creators.json") -> bool:
+        if not os.path.exists(path):
+            return False
+        with open(path, "r", encoding="utf-8") as f:
+            self.replace(json.load(f).values())
+        return True
+
+    def get(self, creator_id: int | str, service: str | None = None) -> dict:
+        query = "SELECT id, service, name, indexed, updated, favorited FROM creators WHERE id = ?"
+        params = [str(creator_id)]
+        if service is not None:
+            query = query + " AND service = ?"
+            params.append(service)
+        with self.lock:
+            row = self.conn.execute(query + " LIMIT 1", params).fetchone()
+        if row is None:
+            return dict()
+        return dict(row)
+
+    # 名前で検索 (完全一致、前方一致、お気に入り数の順)
+    def search(self, word: str, service: str | None = None, limit: int | None = None) -> list:
+        word = word.lower()
+        with self.lock:
+            conn = self.conn
+            conditions = ["instr(name_lower, ?) > 0"]
+            params = [word]
+            if self._fts and len(word) >= 3:
+                conditions.append("rowid IN (SELECT rowid FROM creators_fts WHERE creators_fts MATCH ?)")
+                params.append('"' + word.replace('"', '""') + '"')
+            if service is not None:
+                conditions.append("service = ?")
+                params.append(service)
+            query = (
+                "SELECT id, service, name, indexed, updated, favorited FROM creators WHERE "
+                + " AND ".join(conditions)
+                + " ORDER BY name_lower = ? DESC, substr(name_lower, 1, ?) = ? DESC, favorited DESC"
+            )
+            params.extend([word, len(word), word])
+            if limit is not None:
+                query = query + " LIMIT ?"
+                params.append(limit)
+            return [dict(row) for row in conn.execute(query, params).fetchall()]
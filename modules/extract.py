@@ -0,0 +1,74 @@
+import os
+import shutil
+import subprocess
+import zipfile
+
+# rar/7zの展開に使う外部コマンド
+sevenzip = ["7z", "7zz", "7za"]
+
+
+# zipのファイル名を復元する (UTF-8フラグが無い場合はShift_JISとして読む)
+def member_name(info: zipfile.ZipInfo) -> str:
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("cp932")
+    except UnicodeError:
+        return info.filename
+
+
+# 展開先がフォルダの外を指していないか確認
+def safe_path(root: str, name: str) -> str:
+    path = os.path.normpath(os.path.join(root, name.replace("\\", "/").lstrip("/")))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Unsafe path in archive: {name}")
+    return path
+
+
+# 一件ずつ少しずつ書き出すので、展開後のサイズに関わらずメモリ使用量は一定
+def extract_zip(file: str, dest: str):
+    with zipfile.ZipFile(file) as zf:
+        infos = zf.infolist()
+        total = sum(info.file_size for info in infos)
+        if total > shutil.disk_usage(os.path.dirname(dest)).free:
+            raise OSError(f"Not enough space to extract {total} bytes")
+        for info in infos:
+            path = safe_path(dest, member_name(info))
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with zf.open(info) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def extract_7z(file: str, dest: str):
+    for command in sevenzip:
+        if (exe := shutil.which(command)) is not None:
+            break
+    else:
+        raise FileNotFoundError("7z is not installed")
+    res = subprocess.run([exe, "x", "-y", "-bd", f"-o{dest}", file], capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(res.stderr.strip() or res.stdout.strip())
+
+
+# 書庫と同じ名前のフォルダに展開して、展開先のパスを返す (途中で失敗した場合は何も残さない)
+def extract(file: str) -> str:
+    dest = os.path.splitext(file)[0]
+    tmp = dest + ".extracting"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    try:
+        if zipfile.is_zipfile(file):
+            extract_zip(file, tmp)
+        else:
+            extract_7z(file, tmp)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    os.replace(tmp, dest)
+    return dest
@@ -1,10 +1,14 @@
+import os
 from argparse import Namespace
 
 
 sld = "kemono"
 tld = ["party", "su", "cr"]
 domain = f"{sld}.{tld[-1]}"
-base_url = "https://" + domain
+# ベンチマーク等でモックサーバーを使う場合は環境変数で上書きする
+base_url = os.environ.get("SERVAL_BASE_URL", "https://" + domain)
+# 自動で選択するミラー (カンマ区切りの環境変数で上書きできる)
+mirrors = os.environ.get("SERVAL_MIRRORS", ",".join(f"https://{sld}.{t}" for t in tld)).split(",")
 
 user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:128.0) Gecko/20100101 Firefox/128.0"
 
@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+
+
+# ダウンロード予定の投稿を記録する追記型のジャーナル (完了した添付ファイル毎に確認済みを追記する)
+# {"r": 引数} 実行時の引数、{"a": ID, "d": 投稿} 追加、{"k": ID, "h": ハッシュ} 完了
+class Journal:
+    def __init__(self, path: str = "journal.jsonl", sync_interval: float = 1.0):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.run = f"{int(time.time() * 1000):x}"
+        self.count = 0
+        self.synced = time.monotonic()
+        self._file = None
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    # プロセスが落ちても残るように毎回書き出し、電源断に備えて定期的にfsyncする
+    def _write(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.file.flush()
+        if time.monotonic() - self.synced >= self.sync_interval:
+            os.fsync(self.file.fileno())
+            self.synced = time.monotonic()
+
+    def start(self, args: dict):
+        with self.lock:
+            self._write({"r": args})
+
+    def add(self, data: dict) -> str:
+        with self.lock:
+            self.count = self.count + 1
+            job = f"{self.run}.{self.count}"
+            self._write({"a": job, "d": data})
+        return job
+
+    def ack(self, job: str, key: str):
+        with self.lock:
+            self._write({"k": job, "h": key})
+
+    # 最後の引数と、完了していない添付ファイルが残っている投稿
+    def pending(self) -> tuple:
+        args = None
+        jobs = {}
+        if not os.path.exists(self.path):
+            return args, []
+        with self.lock:
+            if self._file is not None:
+                self._file.flush()
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 書き込み途中で終了した行
+                        continue
+                    if "r" in record:
+                        args = record["r"]
+                    elif "a" in record:
+                        jobs[record["a"]] = record["d"]
+                    elif "k" in record and record["k"] in jobs:
+                        data = jobs[record["k"]]
+                        data["attachments"] = [
+                            a for a in data["attachments"] if (a["hash"] or a["name"]) != record["h"]
+                        ]
+        result = []
+        for job, data in jobs.items():
+            if data["attachments"]:
+                data["job"] = job
+                result.append(data)
+        return args, result
+
+    # 完了していない投稿だけを書き直す (無ければ削除)
+    def compact(self):
+        args, pending = self.pending()
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if not pending:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                if args is not None:
+                    f.write(json.dumps({"r": args}, ensure_ascii=False, separators=(",", ":")) + "\n")
+                for data in pending:
+                    job = data.pop("job")
+                    f.write(json.dumps({"a": job, "d": data}, ensure_ascii=False, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
@@ -0,0 +1,167 @@
+import sqlite3
+import threading
+import time
+
+
+# ダウンロード済みファイルの記録
+class Ledger:
+    def __init__(self, path: str = "ledger.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = []
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS downloads (
+                    service TEXT NOT NULL,
+                    creator_id TEXT NOT NULL,
+                    post_id TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    completed_at REAL NOT NULL,
+                    PRIMARY KEY (service, creator_id, post_id, hash)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sync (
+                    service TEXT NOT NULL,
+                    creator_id TEXT NOT NULL,
+                    post_id TEXT NOT NULL,
+                    published TEXT,
+                    synced_at REAL NOT NULL,
+                    PRIMARY KEY (service, creator_id)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS covers (
+                    service TEXT NOT NULL,
+                    post_id TEXT NOT NULL,
+                    has_cover INTEGER NOT NULL,
+                    PRIMARY KEY (service, post_id)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS processed (
+                    stage TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    mtime REAL NOT NULL,
+                    output TEXT NOT NULL,
+                    processed_at REAL NOT NULL,
+                    PRIMARY KEY (stage, path)
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    # ユーザーの完了済みファイルを一括取得 (似た画像があるため削除したものを含む)
+    def completed(self, service: str, creator_id: str) -> set:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT post_id, hash FROM downloads "
+                "WHERE service = ? AND creator_id = ? AND status IN ('complete', 'similar')",
+                (service, str(creator_id)),
+            ).fetchall()
+        return set(rows)
+
+    def record(self, data: dict, attachment: dict, file: str, size: int, status: str = "complete"):
+        key = attachment["hash"] if attachment["hash"] is not None else attachment["name"]
+        row = (
+            data["service"],
+            str(data["creator_id"]),
+            str(data["post_id"]),
+            key,
+            attachment["name"],
+            file,
+            size,
+            status,
+            time.time(),
+        )
+        with self.lock:
+            self.pending.append(row)
+            if len(self.pending) < 100:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.conn.executemany("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    # 前回同期した最新の投稿
+    def mark(self, service: str, creator_id: str) -> tuple | None:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT post_id, published FROM sync WHERE service = ? AND creator_id = ?",
+                (service, str(creator_id)),
+            ).fetchone()
+
+    def set_mark(self, service: str, creator_id: str, post_id: str, published: str | None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?, ?)",
+                (service, str(creator_id), str(post_id), published, time.time()),
+            )
+            self.conn.commit()
+
+    # カバー画像の判定結果
+    def cover(self, service: str, post_id: str) -> bool | None:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT has_cover FROM covers WHERE service = ? AND post_id = ?", (service, str(post_id))
+            ).fetchone()
+        if row is None:
+            return None
+        return bool(row[0])
+
+    def set_cover(self, service: str, post_id: str, has_cover: bool):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO covers VALUES (?, ?, ?)", (service, str(post_id), int(has_cover)))
+            self.conn.commit()
+
+    # 後処理 (解凍など) を行った時の元ファイルの更新日時と出力先
+    def processed(self, stage: str, path: str) -> tuple | None:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT mtime, output FROM processed WHERE stage = ? AND path = ?", (stage, path)
+            ).fetchone()
+
+    def set_processed(self, stage: str, path: str, mtime: float, output: str):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?)", (stage, path, mtime, output, time.time())
+            )
+            self.conn.commit()
+
+    # ユーザー毎の集計
+    def summary(self, service: str | None = None, creator_id: str | None = None, status: str | None = None) -> list:
+        query = "SELECT service, creator_id, status, COUNT(*), SUM(size), MAX(completed_at) FROM downloads"
+        conditions = []
+        params = []
+        for column, value in (("service", service), ("creator_id", creator_id), ("status", status)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if conditions:
+            query = query + " WHERE " + " AND ".join(conditions)
+        query = query + " GROUP BY service, creator_id, status ORDER BY MAX(completed_at) DESC"
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(buckets)
+        self.counts[i] = self.counts[i] + 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def to_dict(self) -> dict:
+        cumulative = 0
+        result = {}
+        for bound, count in zip([*map(str, buckets), "+Inf"], self.counts):
+            cumulative = cumulative + count
+            result[bound] = cumulative
+        return {"buckets": result, "sum": self.sum, "count": self.count}
+
+
+# 実行中の計測値 (リクエストの遅延、転送量、再試行と失敗の原因、各処理の時間、キューの長さ)
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.latency = {"api": Histogram(), "data": Histogram()}
+        self.bytes = 0
+        self.retries = {}
+        self.failures = {}
+        self.phases = {}
+        self.queue = {"current": 0, "max": 0, "in_flight": 0}
+
+    def observe(self, kind: str, seconds: float):
+        with self.lock:
+            self.latency[kind].observe(seconds)
+
+    def add_bytes(self, size: int):
+        with self.lock:
+            self.bytes = self.bytes + size
+
+    def retry(self, cause: str):
+        with self.lock:
+            self.retries[cause] = self.retries.get(cause, 0) + 1
+
+    def failure(self, cause: str):
+        with self.lock:
+            self.failures[cause] = self.failures.get(cause, 0) + 1
+
+    # 処理毎の時間を積算する (並行して動く処理はそれぞれ計上)
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def queue_depth(self, size: int, in_flight: int):
+        with self.lock:
+            self.queue["current"] = size
+            self.queue["max"] = max(self.queue["max"], size)
+            self.queue["in_flight"] = in_flight
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            return {
+                "elapsed": elapsed,
+                "latency": {kind: histogram.to_dict() for kind, histogram in self.latency.items()},
+                "bytes": self.bytes,
+                "bytes_per_second": self.bytes / elapsed if elapsed else 0.0,
+                "retries": dict(self.retries),
+                "failures": dict(self.failures),
+                "phases": dict(self.phases),
+                "queue": dict(self.queue),
+            }
+
+    def to_prometheus(self) -> str:
+        data = self.to_dict()
+        lines = ["# TYPE serval_request_latency_seconds histogram"]
+        for kind, histogram in data["latency"].items():
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'serval_request_latency_seconds_bucket{{kind="{kind}",le="{bound}"}} {count}')
+            lines.append(f'serval_request_latency_seconds_sum{{kind="{kind}"}} {histogram["sum"]}')
+            lines.append(f'serval_request_latency_seconds_count{{kind="{kind}"}} {histogram["count"]}')
+        lines.append("# TYPE serval_downloaded_bytes_total counter")
+        lines.append(f"serval_downloaded_bytes_total {data['bytes']}")
+        lines.append("# TYPE serval_downloaded_bytes_per_second gauge")
+        lines.append(f"serval_downloaded_bytes_per_second {data['bytes_per_second']}")
+        lines.append("# TYPE serval_retries_total counter")
+        for cause, count in data["retries"].items():
+            lines.append(f'serval_retries_total{{cause="{cause}"}} {count}')
+        lines.append("# TYPE serval_failures_total counter")
+        for cause, count in data["failures"].items():
+            lines.append(f'serval_failures_total{{cause="{cause}"}} {count}')
+        lines.append("# TYPE serval_phase_seconds_total counter")
+        for name, seconds in data["phases"].items():
+            lines.append(f'serval_phase_seconds_total{{phase="{name}"}} {seconds}')
+        lines.append("# TYPE serval_queue_depth gauge")
+        for name, value in data["queue"].items():
+            lines.append(f'serval_queue_depth{{kind="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    # 拡張子が.promの場合はPrometheusのテキスト形式、それ以外はJSONで書き込む
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=4)
+
+
+metrics = Metrics()
@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+
+import requests
+
+from .common import logger
+
+# 移動平均の重みと、たまに他のミラーも試す割合
+alpha = 0.2
+explore_rate = 0.05
+# データの転送時間を見積もる時のファイルサイズ
+data_size = 4 * 1024 * 1024
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.netloc = parse.urlparse(self.url).netloc
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.down_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return self.down_until <= now
+
+    # APIは応答時間、データは応答時間と転送速度から見積もった時間が短い方を優先 (未計測は後回し)
+    def score(self, kind: str) -> float:
+        if self.latency is None:
+            return float("inf")
+        if kind == "data" and self.throughput is not None:
+            return self.latency + data_size / self.throughput
+        return self.latency
+
+
+# ミラー毎の応答時間/転送速度を記録して、速くて落ちていないものにリクエストを振り分ける
+class Mirrors:
+    def __init__(self, base_url: str, urls: list):
+        self.base = parse.urlparse(base_url)
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.configure(True)
+        self.lock = threading.Lock()
+        self.probe_lock = threading.Lock()
+        self.probed = False
+
+    # 本来のホストが候補に無い場合 (モックサーバー等) は振り分けない
+    def configure(self, enabled: bool):
+        known = any(e.netloc == self.base.netloc for e in self.endpoints)
+        self.enabled = enabled and known and len(self.endpoints) > 1
+
+    # 全てのミラーに並行して小さなAPI (バージョン) をリクエストして初期の応答時間を計る
+    def probe(self, timeout: float = 5.0):
+        def measure(endpoint):
+            start = time.monotonic()
+            try:
+                with requests.get(f"{endpoint.url}/api/v1/app_version", timeout=timeout, allow_redirects=False) as res:
+                    # リダイレクトする (廃止された) ミラーは使わない
+                    ok = res.status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            return endpoint, ok, time.monotonic() - start
+
+        with ThreadPoolExecutor(max_workers=len(self.endpoints)) as executor:
+            for endpoint, ok, seconds in executor.map(measure, self.endpoints):
+                if ok:
+                    self.observe(endpoint, seconds)
+                else:
+                    self.failed(endpoint)
+        self.probed = True
+
+    def _choose(self, kind: str, exclude: set) -> Endpoint | None:
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e.netloc not in exclude]
+        if not candidates:
+            return None
+        healthy = [e for e in candidates if e.healthy(now)]
+        if not healthy:
+            # 全て落ちている場合は最も早く復帰するもの
+            return min(candidates, key=lambda e: e.down_until)
+        best = min(healthy, key=lambda e: e.score(kind))
+        if len(healthy) > 1 and random.random() < explore_rate:
+            return random.choice([e for e in healthy if e is not best])
+        return best
+
+    # 本来のホスト宛てのurlを選んだミラー宛てに書き換える (対象外の場合はミラーはNone)
+    def route(self, url: str, kind: str, exclude: set) -> tuple:
+        parsed = parse.urlparse(url)
+        if not self.enabled or parsed.netloc != self.base.netloc:
+            return url, None
+        if not self.probed:
+            with self.probe_lock:
+                if not self.probed:
+                    self.probe()
+        with self.lock:
+            endpoint = self._choose(kind, exclude)
+        if endpoint is None:
+            return url, None
+        target = parse.urlparse(endpoint.url)
+        return parsed._replace(scheme=target.scheme, netloc=target.netloc).geturl(), endpoint
+
+    # 別のミラーが残っているか
+    def has_alternative(self, exclude: set) -> bool:
+        return self.enabled and any(e.netloc not in exclude for e in self.endpoints)
+
+    def observe(self, endpoint: Endpoint, seconds: float):
+        with self.lock:
+            if endpoint.latency is None:
+                endpoint.latency = seconds
+            else:
+                endpoint.latency = endpoint.latency * (1 - alpha) + seconds * alpha
+            endpoint.failures = 0
+
+    def transfer(self, endpoint: Endpoint, size: int, seconds: float):
+        if seconds <= 0 or size <= 0:
+            return
+        speed = size / seconds
+        with self.lock:
+            if endpoint.throughput is None:
+                endpoint.throughput = speed
+            else:
+                endpoint.throughput = endpoint.throughput * (1 - alpha) + speed * alpha
+
+    # 失敗が続くほど長く候補から外す
+    def failed(self, endpoint: Endpoint):
+        with self.lock:
+            endpoint.failures = endpoint.failures + 1
+            endpoint.down_until = time.monotonic() + min(300.0, 10.0 * 2 ** (endpoint.failures - 1))
+        logger.debug(f"mirror: {endpoint.netloc} failed ({endpoint.failures})")
+
+    def report(self) -> list:
+        now = time.monotonic()
+        with self.lock:
+            return [
+                (e.netloc, e.latency, e.throughput, e.failures, e.healthy(now))
+                for e in sorted(self.endpoints, key=lambda e: e.score("api"))
+            ]
@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from PIL import Image
+
+# 64bitのハッシュを16bitずつ4つに分けて、それぞれで完全一致/近傍を引く (multi-index hashing)
+bands = 4
+band_bits = 16
+band_mask = (1 << band_bits) - 1
+# 追加分がこれ (か登録数の1/8) を超えたら並べ直す
+merge_size = 4096
+
+
+# 64bitのdHash (縮小したグレースケール画像で隣り合う画素の明暗を比較)
+def dhash(file: str) -> int:
+    with Image.open(file) as img:
+        img.draft("L", (64, 64))
+        img = img.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = np.asarray(img, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+# SQLiteのINTEGERは符号付きなので変換する
+def to_signed(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+# ハミング距離がradius以下になる16bitのマスク
+def flip_masks(radius: int) -> np.ndarray:
+    masks = [m for m in range(1 << band_bits) if m.bit_count() <= radius]
+    return np.array(masks, dtype=np.uint16)
+
+
+# 画像の知覚ハッシュの索引 (似た画像を全件走査せずに探す)
+class PHashIndex:
+    def __init__(self, path: str = "phash.db"):
+        self.path = path
+        self.lock = threading.RLock()
+        self._conn = None
+        self.loaded = False
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.sorted = []
+        self.recent = []
+        self.masks = {}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS images (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL UNIQUE,
+                    sha256 TEXT,
+                    mtime REAL NOT NULL,
+                    hash INTEGER NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def __len__(self) -> int:
+        with self.lock:
+            self._load()
+            return len(self.hashes) + len(self.recent)
+
+    def _load(self):
+        if self.loaded:
+            return
+        rows = self.conn.execute("SELECT id, hash FROM images").fetchall()
+        if rows:
+            data = np.array(rows, dtype=np.int64)
+            self.ids = data[:, 0].copy()
+            self.hashes = data[:, 1].view(np.uint64).copy()
+        self._build()
+        self.loaded = True
+
+    # 各バンドの値で並べた配列を作成 (searchsortedで引く)
+    def _build(self):
+        self.sorted = []
+        for band in range(bands):
+            values = ((self.hashes >> np.uint64(band * band_bits)) & np.uint64(band_mask)).astype(np.uint16)
+            order = np.argsort(values, kind="stable")
+            self.sorted.append((values[order], order))
+
+    def _merge(self):
+        if not self.recent:
+            return
+        recent = np.array(self.recent, dtype=np.int64)
+        self.ids = np.concatenate([self.ids, recent[:, 0]])
+        self.hashes = np.concatenate([self.hashes, recent[:, 1].view(np.uint64)])
+        self.recent = []
+        self._build()
+
+    # いずれかのバンドがradius以内の候補 (距離distance以内なら鳩の巣原理で必ず含まれる)
+    def _candidates(self, value: int, distance: int) -> np.ndarray:
+        radius = distance // bands
+        if radius not in self.masks:
+            self.masks[radius] = flip_masks(radius)
+        masks = self.masks[radius]
+        found = []
+        for band, (values, order) in enumerate(self.sorted):
+            probes = np.unique(masks ^ np.uint16((value >> (band * band_bits)) & band_mask))
+            left = np.searchsorted(values, probes, side="left")
+            right = np.searchsorted(values, probes, side="right")
+            counts = right - left
+            total = int(counts.sum())
+            if not total:
+                continue
+            # 各範囲 [left, right) を連結した添字
+            starts = np.repeat(left - (np.cumsum(counts) - counts), counts)
+            found.append(order[np.arange(total) + starts])
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    # 距離がdistance以内のid (近い順)
+    def query(self, value: int, distance: int) -> list:
+        with self.lock:
+            self._load()
+            target = np.uint64(value)
+            positions = self._candidates(value, distance)
+            ids = [self.ids[positions]]
+            distances = [popcount(self.hashes[positions] ^ target)]
+            if self.recent:
+                recent = np.array(self.recent, dtype=np.int64)
+                ids.append(recent[:, 0])
+                distances.append(popcount(recent[:, 1].view(np.uint64) ^ target))
+        ids = np.concatenate(ids)
+        distances = np.concatenate(distances)
+        keep = distances <= distance
+        return sorted(zip(distances[keep].tolist(), ids[keep].tolist()))
+
+    # 最も近い別の画像 (同じ内容のファイルは除く) のパスと距離
+    def find(self, value: int, sha256: str | None, distance: int, path: str | None = None) -> tuple | None:
+        for d, _id in self.query(value, distance):
+            with self.lock:
+                row = self.conn.execute("SELECT path, sha256 FROM images WHERE id = ?", (_id,)).fetchone()
+            if row is None or row[0] == path or (sha256 is not None and row[1] == sha256):
+                continue
+            return row[0], d
+        return None
+
+    def add(self, path: str, sha256: str | None, value: int):
+        path = os.path.abspath(path)
+        with self.lock:
+            self._load()
+            cur = self.conn.execute(
+                "INSERT OR REPLACE INTO images (path, sha256, mtime, hash) VALUES (?, ?, ?, ?)",
+                (path, sha256, os.path.getmtime(path), to_signed(value)),
+            )
+            self.conn.commit()
+            self.recent.append((cur.lastrowid, to_signed(value)))
+            if len(self.recent) > max(merge_size, len(self.hashes) // 8):
+                self._merge()
+
+    # 登録済みで更新されていないか
+    def indexed(self, path: str) -> bool:
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.conn.execute("SELECT mtime FROM images WHERE path = ?", (path,)).fetchone()
+        return row is not None and row[0] == os.path.getmtime(path)
+
+    # 距離がdistance以内の組 (同じ内容のファイル同士は除く)
+    def pairs(self, distance: int):
+        with self.lock:
+            self._load()
+            self._merge()
+            rows = self.conn.execute("SELECT id, path, sha256, hash FROM images ORDER BY id").fetchall()
+        info = {row[0]: (row[1], row[2]) for row in rows}
+        for _id, path, sha256, value in rows:
+            for d, other in self.query(value & ((1 << 64) - 1), distance):
+                if other <= _id or other not in info:
+                    continue
+                if sha256 is not None and info[other][1] == sha256:
+                    continue
+                yield path, info[other][0], d
@@ -0,0 +1,49 @@
+import os
+
+from PIL import Image
+
+# プレビューとサムネイルの長辺
+preview_size = 2048
+thumbnail_size = 320
+
+
+def open_image(file: str) -> Image.Image:
+    if file.lower().endswith(".psd"):
+        from psd_tools import PSDImage
+
+        psd = PSDImage.open(file)
+        # 合成に失敗した場合は保存されている統合画像を使う
+        try:
+            img = psd.composite()
+        except Exception:
+            img = None
+        return img if img is not None else psd.topil()
+    return Image.open(file)
+
+
+def save_webp(img: Image.Image, size: int, path: str):
+    img = img.copy()
+    img.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+    img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info else "RGB")
+    tmp = path + ".tmp"
+    img.save(tmp, "WEBP", quality=80, method=4)
+    os.replace(tmp, path)
+
+
+# 同じフォルダの.previewにWebPのプレビュー (PSDと長辺が大きい画像のみ) とサムネイルを作成し、サムネイルのパスを返す
+def preview(file: str) -> str:
+    # ワーカープロセスでは大きな画像も開けるようにする (メモリはプロセス毎に制限する)
+    Image.MAX_IMAGE_PIXELS = None
+    folder = os.path.join(os.path.dirname(file), ".preview")
+    os.makedirs(folder, exist_ok=True)
+    name = os.path.basename(file)
+    with open_image(file) as img:
+        # JPEGはプレビューの大きさに近い解像度で読み込む
+        if img.format == "JPEG":
+            img.draft("RGB", (preview_size, preview_size))
+        img.load()
+        if file.lower().endswith(".psd") or max(img.size) > preview_size:
+            save_webp(img, preview_size, os.path.join(folder, name + ".webp"))
+        thumbnail = os.path.join(folder, name + ".thumb.webp")
+        save_webp(img, thumbnail_size, thumbnail)
+    return thumbnail
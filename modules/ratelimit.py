@@ -0,0 +1,111 @@
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+# 10K, 5M, 1G のような表記をバイト数に変換
+def parse_size(value: str) -> int:
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([KMG]?)B?", value.strip().upper())
+    if m is None:
+        raise ValueError(f"invalid size: {value}")
+    return int(float(m.group(1)) * 1024 ** " KMG".index(m.group(2) or " "))
+
+
+# Retry-Afterヘッダーを秒数に変換
+def retry_after(value: str | None) -> float | None:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# トークンバケット (不足分は借りて待つ)
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def take(self, amount: float = 1):
+        with self.lock:
+            self._refill()
+            self.tokens = self.tokens - amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+# ホスト毎のリクエスト数と帯域の制限
+class HostLimiter:
+    min_rate = 0.2
+
+    def __init__(self, rate: float, bandwidth: int | None):
+        self.max_rate = rate
+        self.rate = rate
+        self.requests = TokenBucket(rate, max(1.0, rate))
+        self.bandwidth = TokenBucket(bandwidth, bandwidth) if bandwidth else None
+        self.pause_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while (wait := self.pause_until - time.monotonic()) > 0:
+            time.sleep(wait)
+        self.requests.take()
+
+    def consume(self, size: int):
+        if self.bandwidth is not None:
+            self.bandwidth.take(size)
+
+    # 429/503が返ってきた場合は速度を半分にして、Retry-Afterの間は待つ
+    def throttled(self, wait: float | None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.requests.set_rate(self.rate)
+            self.pause_until = max(self.pause_until, time.monotonic() + (wait if wait is not None else 1 / self.rate))
+
+    # 正常な応答が続いた場合は少しずつ元の速度に戻す
+    def healthy(self):
+        if self.rate >= self.max_rate:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            self.requests.set_rate(self.rate)
+
+
+class RateLimiter:
+    def __init__(self, rate: float = 10, bandwidth: int | None = None):
+        self.rate = rate
+        self.bandwidth = bandwidth
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def configure(self, rate: float, bandwidth: int | None):
+        with self.lock:
+            self.rate = rate
+            self.bandwidth = bandwidth
+            self.hosts = {}
+
+    def host(self, hostname: str) -> HostLimiter:
+        with self.lock:
+            if hostname not in self.hosts:
+                self.hosts[hostname] = HostLimiter(self.rate, self.bandwidth)
+            return self.hosts[hostname]
@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .common import Color, logger
+from .metrics import metrics
+
+
+# ワーカープロセスのメモリ使用量を制限する (対応していないOSでは何もしない)
+def limit_memory(size: int | None):
+    if size is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+
+
+# ダウンロードと並行して別プロセスで後処理を行う (同時に処理する数と待機数を制限)
+class Stage:
+    def __init__(self, name: str, func, types: list, ledger, workers: int = 2, memory: int | None = None):
+        self.name = name
+        self.func = func
+        self.types = types
+        self.ledger = ledger
+        self.workers = max(1, workers)
+        self.memory = memory
+        self.slots = threading.BoundedSemaphore(self.workers * 2)
+        self.lock = threading.Lock()
+        self.submitted = set()
+        self.result = {"done": 0, "skipped": 0, "failed": 0}
+        self._executor = None
+
+    # プロセスは最初のファイルが来た時に起動する
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=limit_memory,
+                    initargs=(self.memory,),
+                )
+            return self._executor
+
+    def _count(self, key: str):
+        with self.lock:
+            self.result[key] = self.result[key] + 1
+
+    # 前回から変更されていないファイルはスキップ、空きが無い場合は待つ
+    def submit(self, file: str):
+        path = os.path.abspath(file)
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            if path in self.submitted:
+                return
+            self.submitted.add(path)
+        processed = self.ledger.processed(self.name, path)
+        if processed is not None and processed[0] == mtime and os.path.exists(processed[1]):
+            self._count("skipped")
+            return
+        self.slots.acquire()
+        executor = self.executor
+        try:
+            future = executor.submit(self.func, path)
+        except RuntimeError as e:
+            # ワーカープロセスが落ちてプールが使えなくなっている
+            self.slots.release()
+            self._failed(e, path, executor)
+            return
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self._done(f, path, mtime, executor))
+
+    # プールが壊れた場合は次のファイルで作り直す
+    def _reset(self, executor: ProcessPoolExecutor):
+        with self.lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _failed(self, e: BaseException, path: str, executor: ProcessPoolExecutor | None = None):
+        if executor is not None:
+            self._reset(executor)
+        metrics.failure(f"{self.name}:{type(e).__name__}")
+        logger.debug(f"{self.name}: {path}")
+        logger.debug(f"{type(e).__name__}: {e}")
+        self._count("failed")
+
+    def _done(self, future, path: str, mtime: float, executor: ProcessPoolExecutor):
+        self.slots.release()
+        try:
+            output = future.result()
+        except Exception as e:
+            self._failed(e, path, executor if isinstance(e, BrokenProcessPool) else None)
+            return
+        self.ledger.set_processed(self.name, path, mtime, output)
+        self._count("done")
+
+    # 残りの処理が終わるまで待つ
+    def shutdown(self, cancel: bool = False):
+        with self.lock:
+            executor = self._executor
+        if executor is not None:
+            with metrics.phase(f"{self.name}_wait"):
+                executor.shutdown(wait=True, cancel_futures=cancel)
+        if self.result["failed"]:
+            Color.warn(f'{self.result["failed"]} files failed in {self.name}. See .log for details.')
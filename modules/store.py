@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409
+
+
+# kemonoのデータパスからSHA-256を取得
+def path_hash(path: str) -> str | None:
+    m = re.search(r"([0-9a-f]{64})", os.path.basename(path))
+    if m is None:
+        return None
+    return m.group(1)
+
+
+# ハードリンク、リフリンク、コピーの順に試す (リンクできた場合はTrue)
+def link_file(src: str, dst: str) -> bool:
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    shutil.copyfile(src, dst)
+    return False
+
+
+# ハッシュをキーにしたファイルストア
+class Store:
+    def __init__(self, root: str = "./img/.store"):
+        self.root = root
+        self.stats_file = os.path.join(root, "stats.json")
+        self.lock = threading.Lock()
+        self._stats = None
+
+    @property
+    def stats(self) -> dict:
+        if self._stats is None:
+            if os.path.exists(self.stats_file):
+                with open(self.stats_file, "r", encoding="utf-8") as f:
+                    self._stats = json.load(f)
+            else:
+                self._stats = {"links": 0, "bandwidth": 0}
+        return self._stats
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    # ストアにあるファイルを配置、無い場合はFalse
+    def link(self, sha256: str, file: str) -> bool:
+        src = self.object_path(sha256)
+        if not os.path.exists(src):
+            return False
+        link_file(src, file)
+        size = os.path.getsize(file)
+        with self.lock:
+            self.stats["links"] = self.stats["links"] + 1
+            self.stats["bandwidth"] = self.stats["bandwidth"] + size
+        return True
+
+    # ダウンロードしたファイルをストアに登録
+    def add(self, sha256: str, file: str):
+        dst = self.object_path(sha256)
+        if os.path.exists(dst):
+            return
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(file, dst)
+        except FileExistsError:
+            pass
+        except OSError:
+            # ハードリンクできないファイルシステムでは登録しない
+            pass
+
+    def save(self):
+        if self._stats is None:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with self.lock:
+            with open(self.stats_file, "w", encoding="utf-8") as f:
+                json.dump(self._stats, f)
+
+    # 重複排除で節約した容量を集計
+    def report(self) -> dict:
+        objects = 0
+        disk = 0
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if path_hash(name) is None:
+                    continue
+                st = os.stat(os.path.join(root, name))
+                objects = objects + 1
+                # ストア自身と最初の一つを除いたリンクが節約分
+                if st.st_nlink > 2:
+                    disk = disk + (st.st_nlink - 2) * st.st_size
+        return {"objects": objects, "links": self.stats["links"], "bandwidth": self.stats["bandwidth"], "disk": disk}